@@ -2,9 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import contextlib
+import hashlib
+import heapq
+import itertools
 import json
 import os
+import random
+import sqlite3
+import threading
+import time
 from collections import deque
+from email.utils import parsedate_to_datetime
 
 import aiofiles
 import arrow
@@ -15,6 +24,352 @@ import aiohttp
 from yarl import URL
 
 
+PRIORITY_INTERACTIVE_WRITE = 0
+PRIORITY_INTERACTIVE_READ = 1
+PRIORITY_BACKGROUND = 2
+
+
+class RequestDropped(Exception):
+    pass
+
+
+class RateLimiter:
+    # in-process throttle, either a sliding window of MAX_CALLS per TIMEFRAME_MAX_CALLS or an adaptive delay between calls
+    # times are epoch seconds, a slot is reserved when acquired so concurrent callers queue up behind each other
+    # the delay is AIMD controlled: it shrinks by decreaseStep after a healthy response down to minDelay and is
+    # multiplied by backoffFactor after a 429/5xx up to throttleErrorDelay, a Retry-After blocks all calls until it has passed
+    # waiting callers are granted slots by priority (lowest value first), then in arrival order
+
+    def __init__(self, throttleDelay, throttleErrorDelay, maxCalls=None, timeframe=None, minDelay=None, decreaseStep=None, backoffFactor=2, jitter=0.1):
+        self.throttleDelay = throttleDelay or 0
+        self.throttleErrorDelay = max(throttleErrorDelay or 0, self.throttleDelay)
+        self.maxCalls = maxCalls
+        self.timeframe = timeframe
+        self.minDelay = self.throttleDelay if minDelay is None else minDelay
+        self.decreaseStep = decreaseStep if decreaseStep is not None else self.throttleDelay / 10
+        self.backoffFactor = backoffFactor
+        self.jitter = jitter
+        self.delay = self.throttleDelay
+        self.blockedUntil = 0
+        self.lastCallTime = None
+        self.lastStatus = None
+        self.callTimes = deque()
+        self.waiters = []  # heap of (priority, sequence, future, deadline, queuedAt)
+        self.sequence = itertools.count()
+        self.dispatcher = None
+        self.wake = asyncio.Event()  # set by acquire so a sleeping dispatcher sees new waiters and their maxWait
+
+    @property
+    def slidingWindow(self):
+        return bool(self.maxCalls and self.timeframe)
+
+    @staticmethod
+    def _isError(status):
+        return status == 429 or (isinstance(status, int) and 500 <= status < 600)
+
+    def _delay(self, now):
+        blocked = max(0, self.blockedUntil - now)
+        if self.slidingWindow:
+            # Remove timestamps that are outside the current timeframe
+            while self.callTimes and now - self.callTimes[0] > self.timeframe:
+                self.callTimes.popleft()
+
+            if len(self.callTimes) >= self.maxCalls:
+                blocked = max(blocked, self.callTimes[-self.maxCalls] + self.timeframe - now)
+
+            # after a 429/5xx the backed-off delay applies on top of the window
+            if self._isError(self.lastStatus) and self.lastCallTime is not None:
+                blocked = max(blocked, self.lastCallTime + self.delay - now)
+
+        elif self.delay > 0 and self.lastCallTime is not None:
+            return max(blocked, self.lastCallTime + self.delay - now)
+
+        return blocked
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE_READ, maxWait=None):
+        # waits for a slot, raises RequestDropped if none was granted within maxWait seconds
+        now = time.time()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future, now + maxWait if maxWait is not None else None, now))
+        self.wake.set()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        return await future
+
+    def consume(self):
+        # takes a slot without waiting, for a request that has to go out now but must still count against the window
+        now = time.time()
+        if self.slidingWindow:
+            self.callTimes.append(now)
+        self.lastCallTime = now
+
+    def _dropExpired(self, now):
+        expired = [waiter for waiter in self.waiters if waiter[3] is not None and waiter[3] <= now]
+        if expired:
+            self.waiters = [waiter for waiter in self.waiters if waiter not in expired]
+            heapq.heapify(self.waiters)
+            for waiter in expired:
+                if not waiter[2].done():
+                    waiter[2].set_exception(RequestDropped(f"no slot within {now - waiter[4]:.0f} seconds"))
+
+    async def _dispatch(self):
+        while self.waiters:
+            now = time.time()
+            self._dropExpired(now)
+            if not self.waiters:
+                break
+
+            delay = self._delay(now)
+            if delay > 0:
+                if self.jitter:
+                    delay += random.uniform(0, self.jitter * delay)
+                deadlines = [waiter[3] for waiter in self.waiters if waiter[3] is not None]
+                if deadlines:
+                    delay = min(delay, max(0, min(deadlines) - now))
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, future, _, queuedAt = heapq.heappop(self.waiters)
+            if future.done():  # caller was cancelled
+                continue
+            if self.slidingWindow:
+                self.callTimes.append(now)
+            self.lastCallTime = now
+            future.set_result(now - queuedAt)
+
+    def record(self, status, retryAfter=None):
+        now = time.time()
+        self.lastStatus = status
+        self.lastCallTime = now if self.lastCallTime is None else max(self.lastCallTime, now)
+
+        if self._isError(status):
+            self.delay = min(self.throttleErrorDelay, max(self.delay, self.minDelay, 1) * self.backoffFactor)
+        elif isinstance(status, int) and 200 <= status < 300:
+            self.delay = max(self.minDelay, self.delay - self.decreaseStep)
+
+        if retryAfter:
+            self.blockedUntil = max(self.blockedUntil, now + retryAfter)
+
+    @staticmethod
+    def parseRetryAfter(value):
+        # Retry-After is either seconds or an HTTP date
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def rateInfo(self):
+        return {"delay": self.delay,
+                "blockedUntil": self.blockedUntil,
+                "lastStatus": self.lastStatus}
+
+    def load(self, entries, timeZone):
+        # restore from the journal tail, oldest entry first
+        legacy = False
+        for entry in entries:
+            legacy = "delay" not in entry
+            if "lastSessionTime" in entry:  # lastsessionfile written before the journal
+                self.lastCallTime = arrow.get(entry["lastSessionTime"], tzinfo=timeZone).timestamp()
+                self.callTimes.extend(arrow.get(ts, tzinfo=timeZone).timestamp() for ts in entry.get("callTimes", []))
+            elif entry.get("time"):
+                self.lastCallTime = arrow.get(entry["time"], tzinfo=timeZone).timestamp()
+                self.callTimes.append(self.lastCallTime)
+            self.lastStatus = entry.get("lastStatus", entry.get("status"))
+            if entry.get("delay") is not None:
+                self.delay = min(self.throttleErrorDelay, max(self.minDelay, entry["delay"]))
+            if entry.get("blockedUntil"):
+                self.blockedUntil = entry["blockedUntil"]
+        self.callTimes = deque(sorted(self.callTimes))
+        if legacy and self.lastStatus == 429 and not self.blockedUntil and self.lastCallTime:
+            # lastsessionfile without a learned rate, keep the previous THROTTLE_ERROR_DELAY blackout
+            self.blockedUntil = self.lastCallTime + self.throttleErrorDelay
+
+
+class SessionJournal:
+    # append-only JSONL log of requests, buffered in memory and flushed in batches,
+    # rotated to <fileName>.1 when it grows past maxBytes
+
+    log = structlog.get_logger(__name__)
+
+    def __init__(self, fileName, storeBody=False, flushSize=50, maxBytes=1024*1024):
+        self.fileName = fileName
+        self.storeBody = storeBody
+        self.flushSize = flushSize
+        self.maxBytes = maxBytes
+        self.buffer = []
+        self.needsNewline = False
+        self.lock = asyncio.Lock()
+
+    def append(self, timestamp, url, status, text, **extra):
+        text = text or ""
+        entry = {"time": timestamp,
+                 "status": status,
+                 "url": url,
+                 "size": len(text),
+                 "hash": hashlib.sha1(text.encode("utf-8")).hexdigest(),
+                 **extra}
+        if self.storeBody:
+            entry["text"] = text
+        self.buffer.append(entry)
+        return len(self.buffer) >= self.flushSize
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            entries, self.buffer = self.buffer, []
+            try:
+                lines = "".join(ujson.dumps(entry) + "\n" for entry in entries)
+                if self.needsNewline:
+                    lines = "\n" + lines
+                    self.needsNewline = False
+                async with aiofiles.open(self.fileName, mode="a", encoding="utf-8") as f:
+                    await f.write(lines)
+
+                if os.path.getsize(self.fileName) > self.maxBytes:
+                    os.replace(self.fileName, f"{self.fileName}.1")
+
+            except Exception as e:
+                self.log.error(f"Exception in SessionJournal.flush", filename=self.fileName, error=e)
+
+    async def _readLastLines(self, fileName, count, blockSize=4096):
+        if not os.path.exists(fileName):
+            return []
+        async with aiofiles.open(fileName, mode="rb") as f:
+            end = await f.seek(0, os.SEEK_END)
+            position, data = end, b""
+            while position > 0 and data.count(b"\n") <= count:
+                position = max(0, position - blockSize)
+                await f.seek(position)
+                data = await f.read(end - position)
+        if fileName == self.fileName:
+            self.needsNewline = bool(data) and not data.endswith(b"\n")
+        return [line for line in data.split(b"\n") if line.strip()][-count:]
+
+    async def readTail(self, count):
+        # returns the last count entries, oldest first, reading only the end of the journal
+        lines = await self._readLastLines(self.fileName, count)
+        if len(lines) < count:
+            lines = (await self._readLastLines(f"{self.fileName}.1", count - len(lines))) + lines
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                self.log.warning(f"SessionJournal skipping damaged line", filename=self.fileName)
+        return entries
+
+
+class StateStore:
+    # embedded sqlite store in WAL mode replacing the per handler json files, one connection per database and process
+    # every former file is a name with its top level keys as rows so one key can be replaced on its own,
+    # the methods block and are run with asyncio.to_thread
+
+    log = structlog.get_logger(__name__)
+
+    _instances = {}
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = threading.Lock()  # the connection is shared by the worker threads
+        self.connection = sqlite3.connect(fileName, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (name, key))")
+
+    @classmethod
+    def open(cls, fileName):
+        if fileName not in cls._instances:
+            cls._instances[fileName] = cls(fileName)
+        return cls._instances[fileName]
+
+    def read(self, name):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM state WHERE name = ?", (name,)).fetchall()
+        return {key: ujson.loads(value) for key, value in rows}
+
+    def write(self, name, contents):
+        rows = [(name, key, ujson.dumps(value)) for key, value in contents.items()]
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM state WHERE name = ?", (name,))
+            self.connection.executemany("INSERT INTO state (name, key, value) VALUES (?, ?, ?)", rows)
+
+    def update(self, name, key, value):
+        with self.lock:
+            self.connection.execute("INSERT INTO state (name, key, value) VALUES (?, ?, ?) ON CONFLICT (name, key) DO UPDATE SET value = excluded.value",
+                                    (name, key, ujson.dumps(value)))
+
+
+class SingleFlight:
+    # identical calls made while one is already running share its task and result instead of starting their own
+
+    def __init__(self):
+        self.inflight = {}
+
+    async def do(self, key, factory):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _task: self._done(key, _task))
+        # shielded so one cancelled caller does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+
+class PrioritySemaphore:
+    # semaphore whose waiters are woken by priority (lowest value first), then in arrival order
+
+    def __init__(self, value):
+        self.value = value
+        self.waiters = []  # heap of (priority, sequence, future)
+        self.sequence = itertools.count()
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE_READ):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():  # granted just before the cancel, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self.value += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=PRIORITY_INTERACTIVE_READ):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
 class APISessionHandler:
     log = structlog.get_logger(__name__)
 
@@ -22,11 +377,12 @@ class APISessionHandler:
     DATE_FORMAT = "YYYY-MM-DD HH:mm:ss"
 
     # _instances = {}
+    _probeCache = {}  # probeUrl -> time of last successful probe, shared by all handlers
 
     def __init__(self):
         pass
 
-    def __init__(self, name, tokenFileName, lastSessionFileName, headers, RETRIES, RETRY_DELAY, THROTTLE_DELAY, THROTTLE_ERROR_DELAY, loginUrls, MAX_CALLS=None, TIMEFRAME_MAX_CALLS=None, logoutUrls=None, BASE_URL=None, refreshUrls=None, data=None, auth=None, commonSession=None):
+    def __init__(self, name, tokenFileName, lastSessionFileName, headers, RETRIES, RETRY_DELAY, THROTTLE_DELAY, THROTTLE_ERROR_DELAY, loginUrls, MAX_CALLS=None, TIMEFRAME_MAX_CALLS=None, logoutUrls=None, BASE_URL=None, refreshUrls=None, data=None, auth=None, commonSession=None, SESSION_PERSIST_INTERVAL=60, MAX_CONCURRENT_REQUESTS=4, JOURNAL_BODY=False, JOURNAL_MAX_BYTES=1024*1024, stateStoreFileName=None, probeUrl="http://google.com", PROBE_TTL=300, connector=None, SINGLE_FLIGHT_GETS=True, TOKEN_REFRESH_MARGIN=300, MIN_THROTTLE_DELAY=None):
         self.name = name
         self.tokenFileName = tokenFileName
         self.lastSessionFileName = lastSessionFileName
@@ -38,6 +394,8 @@ class APISessionHandler:
         self.THROTTLE_ERROR_DELAY = THROTTLE_ERROR_DELAY
         self.MAX_CALLS = MAX_CALLS
         self.TIMEFRAME_MAX_CALLS = TIMEFRAME_MAX_CALLS
+        self.SESSION_PERSIST_INTERVAL = SESSION_PERSIST_INTERVAL
+        self.MAX_CONCURRENT_REQUESTS = MAX_CONCURRENT_REQUESTS
         self.loginUrls = loginUrls or []
         self.logoutUrls = logoutUrls or []
         # self.BASE_URL = BASE_URL
@@ -45,17 +403,32 @@ class APISessionHandler:
         self.refreshUrls = refreshUrls or []
         self.auth = auth
         self.commonSession = commonSession
-
-        self.doSessionLock = asyncio.Lock()
+        self.connector = connector  # shared aiohttp connector, owned by the caller
+        self.SINGLE_FLIGHT_GETS = SINGLE_FLIGHT_GETS
+        self.TOKEN_REFRESH_MARGIN = TOKEN_REFRESH_MARGIN
+        self.singleFlight = SingleFlight()
+        self.stateStore = StateStore.open(stateStoreFileName) if stateStoreFileName else None
+        self.probeUrl = probeUrl
+        self.PROBE_TTL = PROBE_TTL
+
+        # requests run in parallel up to MAX_CONCURRENT_REQUESTS, the rateLimiter keeps the throttle budget and loginLock serializes login/refresh
+        self.doSessionSemaphore = PrioritySemaphore(MAX_CONCURRENT_REQUESTS)
         self.loginLock = asyncio.Lock()
         self.validateLock = asyncio.Lock()
         self.fileLock = asyncio.Lock()
 
         self.tokenExpires = None
         self.refreshTokenExpires = None
+        self.tokenFileRead = False
+        self.tokenRefreshTask = None
+        self.tokenGeneration = 0  # bumped on every successful login/refresh
+        self.reauthTask = None
         self.lastWorkingUrl = None
         self.session = None
-        self.callTimes = deque()
+        self.rateLimiter = RateLimiter(THROTTLE_DELAY, THROTTLE_ERROR_DELAY, MAX_CALLS, TIMEFRAME_MAX_CALLS, minDelay=MIN_THROTTLE_DELAY)
+        self.journal = SessionJournal(lastSessionFileName, storeBody=JOURNAL_BODY, maxBytes=JOURNAL_MAX_BYTES) if lastSessionFileName else None
+        self.persistTask = None
+        self.flushTask = None
 
     @classmethod
     async def create(cls, *args, **params):
@@ -66,7 +439,9 @@ class APISessionHandler:
             # instance.session = ClientSession(base_url=instance.BASE_URL) if instance.BASE_URL else ClientSession()
             # instance._session = params.pop("commonSession", None)
             # instance.session = await instance._init_session()
+            await instance._readSessionFile()
             await instance._initSession()
+            instance.startTokenRefresher()
             # return cls._instances[cls]
             return instance
 
@@ -110,13 +485,21 @@ class APISessionHandler:
     '''
 
     async def internetUP(self, retries=5, delay=5):
+        if self.probeUrl is None:
+            return True
+
+        lastProbe = self._probeCache.get(self.probeUrl)
+        if lastProbe is not None and time.monotonic() - lastProbe < self.PROBE_TTL:
+            return True
+
         out = False
         for attempt in range(retries):
             try:
                 async with aiohttp.ClientSession() as _session:
-                    async with _session.get('http://google.com') as resp:
+                    async with _session.get(self.probeUrl) as resp:
                         if resp.status == 200:
                             self.log.info("Internet connection is up")
+                            self._probeCache[self.probeUrl] = time.monotonic()
                             out = True
 
                 return out
@@ -130,13 +513,16 @@ class APISessionHandler:
     async def _initSession(self):
         try:
             if self.session is None or self.session.closed:
-                if await self.internetUP():
-                    self.session = self.commonSession if self.commonSession is not None else aiohttp.ClientSession()
+                if self.commonSession is not None:
+                    self.session = self.commonSession
+                elif await self.internetUP():
+                    self.session = aiohttp.ClientSession(connector=self.connector, connector_owner=False) if self.connector is not None else aiohttp.ClientSession()
 
         except Exception as e:
             self.log.error(f"Exception in _init_session", error=e)
 
     async def closeSession(self):
+        await self._writeSessionFile()
         if self.session and not self.session.closed:
             await self.session.close()
             self.session = None
@@ -159,143 +545,137 @@ class APISessionHandler:
     async def localPreDoSession(self, param):
         pass
 
-    async def doSession(self, internalCall=False, skipThrottle=False, **kwargs):
+    async def doSession(self, internalCall=False, skipThrottle=False, priority=PRIORITY_INTERACTIVE_READ, maxWait=None, **kwargs):
+        # priority decides who gets the next rate limited slot, a request still waiting after maxWait seconds is dropped
+        # identical GETs already in flight share one request, callers get the same result object
+        if self.SINGLE_FLIGHT_GETS and kwargs.get("method") == "GET":
+            return await self.singleFlight.do(self._requestKey(internalCall, skipThrottle, priority, kwargs),
+                                              lambda: self._doSession(internalCall=internalCall, skipThrottle=skipThrottle, priority=priority, maxWait=maxWait, **kwargs))
+        return await self._doSession(internalCall=internalCall, skipThrottle=skipThrottle, priority=priority, maxWait=maxWait, **kwargs)
 
-        async def _writeSessionFile(url, status, text):
-            try:
-                _now = arrow.now(self.TIME_ZONE)
-
-                if self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS:
-                    self.callTimes.append(_now)
-                    # Remove timestamps that are outside the current timeframe
-                    # while self.callTimes and (_now - self.callTimes[0]).total_seconds() > self.TIMEFRAME_MAX_CALLS:
-                    #    self.callTimes.popleft()
-
-                    await self._writeFileAsync(self.lastSessionFileName, {"lastSessionTime": _now.format(self.DATE_FORMAT),
-                                                                          "lastStatus": status,
-                                                                          "lastUrl": url,
-                                                                          "lastText": text,
-                                                                          "callTimes": [ts.format(self.DATE_FORMAT) for ts in self.callTimes or []]})
-                else:
-                    await self._writeFileAsync(self.lastSessionFileName, {"lastSessionTime": _now.format(self.DATE_FORMAT),
-                                                                          "lastStatus": status,
-                                                                          "lastUrl": url,
-                                                                          "lastText": text})
-
-            except Exception as e:
-                self.log.error(f"Exception in _writeSessionFile", error=e)
+    @staticmethod
+    def _requestKey(internalCall, skipThrottle, priority, kwargs):
+        _urls = kwargs.get("url")
+        return (internalCall,
+                skipThrottle,
+                priority,
+                kwargs.get("method"),
+                tuple(_urls) if isinstance(_urls, list) else _urls,
+                tuple(sorted((kwargs.get("params") or {}).items())),
+                kwargs.get("data") if isinstance(kwargs.get("data"), (str, bytes)) else None)
+
+    async def _doSession(self, internalCall=False, skipThrottle=False, priority=PRIORITY_INTERACTIVE_READ, maxWait=None, **kwargs):
 
         async def _waitForThrottle():
             try:
-                _now = arrow.now(self.TIME_ZONE)
-                if self.lastSessionFileName:
-                    lastSessionData = await self._readFileAsync(self.lastSessionFileName)
-                    if lastSessionData:
-                        if self.MAX_CALLS and self.TIMEFRAME_MAX_CALLS:
-                            self.callTimes = deque([arrow.get(ts, tzinfo=self.TIME_ZONE) for ts in lastSessionData.get("callTimes", [])])
-                            # Remove timestamps that are outside the current timeframe
-                            while self.callTimes and (_now - self.callTimes[0]).total_seconds() > self.TIMEFRAME_MAX_CALLS:
-                                self.callTimes.popleft()
-
-                            # Check if the number of calls exceeds the maximum allowed
-                            if len(self.callTimes) >= self.MAX_CALLS:
-                                nextCallTime = self.callTimes[0].shift(seconds=self.TIMEFRAME_MAX_CALLS)
-                                delaySeconds = (nextCallTime - _now).total_seconds()
-                                self.log.info(f"{self.name} waiting {int(delaySeconds)} seconds due to rate limiting", lencallTimes=len(self.callTimes))
-                                await asyncio.sleep(delaySeconds)
-                                # self.callTimes.clear()
-
-                        elif self.THROTTLE_DELAY > 0:
-                            lastSessionTime = arrow.get(lastSessionData.get("lastSessionTime"), tzinfo=self.TIME_ZONE)
-                            lastStatus = lastSessionData.get("lastStatus")
-                            delay = self.THROTTLE_ERROR_DELAY if lastStatus == 429 else self.THROTTLE_DELAY
-                            nextCallTime = lastSessionTime.shift(seconds=delay)
-                            if nextCallTime > _now:
-                                delaySeconds = (nextCallTime - _now).total_seconds()
-                                self.log.info(f"{self.name} waiting {int(delaySeconds)} seconds before next call")
-                                await asyncio.sleep(delaySeconds)
-
-                    else:
-                        self.log.warning(f"{self.name} lastsessionfile damaged or missing")
+                delaySeconds = await self.rateLimiter.acquire(priority=priority, maxWait=maxWait)
+                if delaySeconds > 0:
+                    self.log.info(f"{self.name} waited {int(delaySeconds)} seconds due to rate limiting", priority=priority, lencallTimes=len(self.rateLimiter.callTimes))
+
+            except RequestDropped:
+                raise
 
             except Exception as e:
                 self.log.error(f"Exception in _waitForThrottle", error=e)
 
         async def _innerDoSession():
             nonlocal kwargs
+            reauthenticated = False
             for attempt in range(self.RETRIES):
                 try:
                     if not skipThrottle:
-                        await _waitForThrottle()
+                        # a retry right after a re-authentication goes out without a new throttle wait, it still counts
+                        if not reauthenticated:
+                            await _waitForThrottle()
+                        else:
+                            self.rateLimiter.consume()
+                        reauthenticated = False
                         if not await self._tokenValid():
                             if not await self.login(internalCall=True):
                                 return None
 
-                    for index, url in enumerate(_urls):
-                        kwargs["url"] = self.BASE_URL.join(URL(url)) if self.BASE_URL is not None else URL(url)
-                        kwargs["headers"] = self.headers
-                        newKwargs = await self.localPreDoSession(kwargs)
-                        kwargs = newKwargs if newKwargs is not None else kwargs
-                        self.log.debug(f"{self.name} preforming request to {kwargs.get('url')}")
-                        # Ensure shared session is initialized
-                        await self._initSession()
-                        async with self.session.request(**kwargs) as response:
-                            if 200 <= response.status < 300:
-                                content_type = response.headers.get('Content-Type', '').lower()
-                                if 'application/json' in content_type:
-                                    result = await response.json()
-                                    await _writeSessionFile(kwargs.get('url').human_repr(), response.status, ujson.dumps(result))
-                                    if not _urlPool or self.localUrlPoolCheck(result):
-                                        self.lastWorkingUrl = url
-                                        return result
-                                    if index == len(_urls) - 1:  # last item
-                                        self.log.warning(f"{self.name} failed with urlPool attempt {attempt+1}, retrying in {self.RETRY_DELAY} seconds...")
-                                        await asyncio.sleep(self.RETRY_DELAY)
-                                else:
-                                    self.log.error(f"{self.name} received unexpected content type: {content_type}. Expected 'application/json'. Response text: {await response.text()}")
-                                    await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                    if index == len(_urls) - 1:
-                                        await asyncio.sleep(self.RETRY_DELAY)
-
-                            elif response.status == 401:
-                                self.log.warning(f"{self.name} 401 unauthorized attempt {attempt+1}")
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                if not self.loginLock.locked():
-                                    if not await self.login(internalCall=True, forceLogin=True):
+                    # a lane is only held while the request is on the wire, waiting for the rateLimiter and retry
+                    # backoffs happen outside it so a queued interactive request is not stuck behind other requests
+                    backoff = 0
+                    async with lane():
+                        for index, url in enumerate(_urls):
+                            generation = self.tokenGeneration
+                            kwargs["url"] = self.BASE_URL.join(URL(url)) if self.BASE_URL is not None else URL(url)
+                            kwargs["headers"] = self.headers
+                            newKwargs = await self.localPreDoSession(kwargs)
+                            kwargs = newKwargs if newKwargs is not None else kwargs
+                            self.log.debug(f"{self.name} preforming request to {kwargs.get('url')}")
+                            # Ensure shared session is initialized
+                            await self._initSession()
+                            async with self.session.request(**kwargs) as response:
+                                if 200 <= response.status < 300:
+                                    content_type = response.headers.get('Content-Type', '').lower()
+                                    if 'application/json' in content_type:
+                                        result = await response.json()
+                                        self._recordSession(kwargs.get('url').human_repr(), response.status, ujson.dumps(result))
+                                        if not _urlPool or self.localUrlPoolCheck(result):
+                                            self.lastWorkingUrl = url
+                                            return result
+                                        if index == len(_urls) - 1:  # last item
+                                            self.log.warning(f"{self.name} failed with urlPool attempt {attempt+1}, retrying in {self.RETRY_DELAY} seconds...")
+                                            backoff = self.RETRY_DELAY
+                                    else:
+                                        self.log.error(f"{self.name} received unexpected content type: {content_type}. Expected 'application/json'. Response text: {await response.text()}")
+                                        self._recordSession(kwargs.get('url').human_repr(), response.status, await response.text())
+                                        if index == len(_urls) - 1:
+                                            backoff = self.RETRY_DELAY
+
+                                elif response.status == 401:
+                                    self.log.warning(f"{self.name} 401 unauthorized attempt {attempt+1}")
+                                    self._recordSession(kwargs.get('url').human_repr(), response.status, await response.text())
+                                    if skipThrottle:  # login, refresh and logout requests do not re-authenticate themselves
                                         return None
-                                    self.log.warning(f"{self.name} retrying request attempt {attempt+1} in {self.RETRY_DELAY} seconds...")
-                                    await asyncio.sleep(self.RETRY_DELAY)
+                                    if not await self._reauthenticate(generation):
+                                        return None
+                                    self.log.warning(f"{self.name} retrying request attempt {attempt+1} with new token")
+                                    reauthenticated = True
                                     break
 
-                            elif response.status == 404:
-                                self.log.error(f"{self.name} 404 not found attempt {attempt+1}")
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                return
+                                elif response.status == 404:
+                                    self.log.error(f"{self.name} 404 not found attempt {attempt+1}")
+                                    self._recordSession(kwargs.get('url').human_repr(), response.status, await response.text())
+                                    return
+
+                                elif response.status == 429:
+                                    retryAfter = self.rateLimiter.parseRetryAfter(response.headers.get("Retry-After"))
+                                    self._recordSession(kwargs.get('url').human_repr(), response.status, await response.text(), retryAfter=retryAfter)
+                                    self.log.warning(f"{self.name} 429 too many requests attempt {attempt+1}", retryAfter=retryAfter, rate=self.rateLimiter.rateInfo())
+                                    if skipThrottle:
+                                        backoff = retryAfter or self.RETRY_DELAY
+                                    # otherwise the next attempt waits in the rateLimiter, which has backed off
+                                    break
 
-                            elif response.status == 429:
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                self.log.warning(f"{self.name} 429 too many requests attempt {attempt+1}, retrying after {self.RETRY_DELAY} seconds...", callTimes=self.callTimes)
-                                await asyncio.sleep(self.RETRY_DELAY)
-                                break
+                                else:
+                                    retryAfter = self.rateLimiter.parseRetryAfter(response.headers.get("Retry-After"))
+                                    self.log.error(f"{self.name} request failed with status {response.status} attempt {attempt+1} retrying in {retryAfter or self.RETRY_DELAY} seconds...", url=kwargs.get('url'), params=kwargs.get("params"))
+                                    self._recordSession(kwargs.get('url').human_repr(), response.status, await response.text(), retryAfter=retryAfter)
+                                    backoff = max(backoff, retryAfter or self.RETRY_DELAY)
 
-                            else:
-                                self.log.error(f"{self.name} request failed with status {response.status} attempt {attempt+1} retrying in {self.RETRY_DELAY} seconds...", url=kwargs.get('url'), params=kwargs.get("params"))
-                                await _writeSessionFile(kwargs.get('url').human_repr(), response.status, await response.text())
-                                await asyncio.sleep(self.RETRY_DELAY)
+                    if backoff:
+                        await asyncio.sleep(backoff)
 
                 except aiohttp.ClientConnectionError as e:
                     _delay = min(self.RETRY_DELAY * (2 ** attempt), self.RETRY_DELAY * (2 ** self.RETRIES))
                     _status = response.status if 'response' in locals() else 500  # Default to 500 if response is not defined
                     self.log.error(f"{self.name} ClientConnectionError attempt {attempt+1} retrying in {_delay} seconds...", error=e, url=kwargs.get('url'), params=kwargs.get("params"))
-                    await _writeSessionFile(url, _status, f"{type(e).__name__}: {str(e)}")
+                    self._recordSession(url, _status, f"{type(e).__name__}: {str(e)}")
                     await asyncio.sleep(_delay)
                     # reset sessionen bara och det inte är en gemensam session
                     if self.commonSession is None:
                         await self.closeSession()
 
+                except RequestDropped as e:
+                    self.log.info(f"{self.name} request dropped while waiting for the rate limiter", priority=priority, reason=str(e))
+                    return None
+
                 except Exception as e:
                     self.log.error(f"{self.name} Exception in _innerDoSession attempt {attempt+1} retrying in {self.RETRY_DELAY} seconds...", url=kwargs.get('url'), params=kwargs.get("params"))
-                    await _writeSessionFile(url, 999, f"{type(e).__name__}: {str(e)}")
+                    self._recordSession(url, 999, f"{type(e).__name__}: {str(e)}")
                     await asyncio.sleep(self.RETRY_DELAY)
 
             self.log.error(f"{self.name} _innerDoSession max retries reached")
@@ -318,34 +698,128 @@ class APISessionHandler:
             elif self.lastWorkingUrl in _urls:
                 _urls = self._moveToFront(self.lastWorkingUrl, _urls)
 
-        if not internalCall:
-            async with self.doSessionLock:
-                return await _innerDoSession()
-        else:
-            return await _innerDoSession()
+        lane = (lambda: self.doSessionSemaphore.slot(priority)) if not internalCall else contextlib.nullcontext
+        return await _innerDoSession()
+
+    def _recordSession(self, url, status, text, retryAfter=None):
+        self.rateLimiter.record(status, retryAfter=retryAfter)
+        if self.journal is not None:
+            if self.journal.append(arrow.now(self.TIME_ZONE).format(self.DATE_FORMAT), url, status, text,
+                                   delay=self.rateLimiter.delay, blockedUntil=self.rateLimiter.blockedUntil or None):
+                if self.flushTask is None or self.flushTask.done():
+                    self.flushTask = asyncio.create_task(self._writeSessionFile())
+            if self.persistTask is None or self.persistTask.done():
+                self.persistTask = asyncio.create_task(self._persistSessionLoop())
+
+    async def _persistSessionLoop(self):
+        while self.journal.buffer:
+            await asyncio.sleep(self.SESSION_PERSIST_INTERVAL)
+            await self._writeSessionFile()
+
+    async def _readSessionFile(self):
+        # read once at startup, after that the rateLimiter is the source of truth
+        try:
+            if self.journal is not None:
+                entries = await self.journal.readTail(max(1, self.MAX_CALLS or 0))
+                if entries:
+                    self.rateLimiter.load(entries, self.TIME_ZONE)
+                else:
+                    self.log.warning(f"{self.name} lastsessionfile damaged or missing")
+
+        except Exception as e:
+            self.log.error(f"Exception in _readSessionFile", error=e)
+
+    async def _writeSessionFile(self):
+        if self.journal is not None:
+            await self.journal.flush()
 
-    async def login(self, internalCall=False, forceLogin=False):
+    async def login(self, internalCall=False, forceLogin=False, staleGeneration=None):
         try:
             async with self.loginLock:
-                if not forceLogin and await self._getTokenFromFile():
+                if staleGeneration is not None and staleGeneration != self.tokenGeneration:
+                    # someone else logged in while we waited for the lock
                     return True
 
+                if not forceLogin:
+                    # the token is kept in memory, the file is only read on the first login
+                    if self.tokenExpires is not None and await self._tokenValid():
+                        return True
+                    if not self.tokenFileRead:
+                        self.tokenFileRead = True
+                        if await self._getTokenFromFile():
+                            self.tokenGeneration += 1
+                            return True
+
                 if self.refreshUrls and await self._tokenValid(self.refreshTokenExpires):
                     self.log.info(f"{self.name} refreshing token")
                     if await self.localDoRefresh(internalCall=internalCall):
+                        self.tokenGeneration += 1
                         return True
                 else:
                     self.log.info(f"{self.name} has no refreshUrl or refreshtoken expired")
 
                 self.log.info(f"{self.name} performing login")
                 if await self.localDoLogin(internalCall=internalCall):
+                    self.tokenGeneration += 1
                     return True
 
         except Exception as e:
             self.log.error(f"Exception in login", error=e)
 
+    async def _reauthenticate(self, generation):
+        # all requests that got a 401 with the token of this generation wait for one shared login
+        if generation != self.tokenGeneration:
+            return True
+        if self.reauthTask is None or self.reauthTask.done():
+            self.reauthTask = asyncio.create_task(self.login(internalCall=True, forceLogin=True, staleGeneration=generation))
+        return await asyncio.shield(self.reauthTask)
+
     async def logout(self):
-        await self.localDoLogout()
+        self.stopTokenRefresher()
+        try:
+            await self.localDoLogout()
+        finally:
+            # localDoLogout closes the session itself, the journal with the learned rate is persisted here
+            if self.persistTask is not None:
+                self.persistTask.cancel()
+                self.persistTask = None
+            if self.flushTask is not None:
+                await self.flushTask
+            await self._writeSessionFile()
+
+    def startTokenRefresher(self):
+        if self.TOKEN_REFRESH_MARGIN is not None and self.tokenFileName is not None and (self.tokenRefreshTask is None or self.tokenRefreshTask.done()):
+            self.tokenRefreshTask = asyncio.create_task(self._tokenRefreshLoop())
+
+    def stopTokenRefresher(self):
+        if self.tokenRefreshTask is not None:
+            self.tokenRefreshTask.cancel()
+            self.tokenRefreshTask = None
+
+    async def _tokenRefreshLoop(self):
+        # renews the token TOKEN_REFRESH_MARGIN seconds before tokenExpires so requests never wait for a login
+        while True:
+            try:
+                if self.tokenExpires is None:
+                    if not await self.login(internalCall=True):
+                        await asyncio.sleep(self.RETRY_DELAY or self.TOKEN_REFRESH_MARGIN)
+                    continue
+
+                delay = (self.tokenExpires - arrow.now(self.TIME_ZONE)).total_seconds() - self.TOKEN_REFRESH_MARGIN
+                if delay > 0:
+                    await asyncio.sleep(min(delay, 60*60))
+                    continue
+
+                self.log.info(f"{self.name} renewing token in background", tokenExpires=self.tokenExpires)
+                if not await self.login(internalCall=True, forceLogin=True):
+                    await asyncio.sleep(self.RETRY_DELAY or self.TOKEN_REFRESH_MARGIN)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                self.log.error(f"Exception in _tokenRefreshLoop", error=e)
+                await asyncio.sleep(self.RETRY_DELAY or self.TOKEN_REFRESH_MARGIN)
 
     async def _tokenValid(self, timecheck=None):
         if self.tokenFileName is not None:
@@ -394,6 +868,47 @@ class APISessionHandler:
         return new_lst
 
     async def _readFileAsync(self, filename):
+        if self.stateStore is not None:
+            try:
+                contents = await asyncio.to_thread(self.stateStore.read, filename)
+                if not contents:
+                    # first use of the store, import the old json file if there is one
+                    contents = await self._readJsonFileAsync(filename)
+                    if contents:
+                        self.log.info(f"{self.name} importing file into state store", filename=filename)
+                        await asyncio.to_thread(self.stateStore.write, filename, contents)
+                return contents
+
+            except Exception as e:
+                self.log.error(f"Exception in _readFileAsync", filename=filename, error=e)
+                return {}
+
+        return await self._readJsonFileAsync(filename)
+
+    async def _writeFileAsync(self, filename, contents):
+        if self.stateStore is not None:
+            try:
+                await asyncio.to_thread(self.stateStore.write, filename, contents)
+            except Exception as e:
+                self.log.error(f"Exception in _writeFileAsync", filename=filename, error=e)
+            return
+
+        await self._writeJsonFileAsync(filename, contents)
+
+    async def _updateFileAsync(self, filename, key, value):
+        # replaces one top level key, a single row upsert in the state store
+        if self.stateStore is not None:
+            try:
+                await asyncio.to_thread(self.stateStore.update, filename, key, value)
+            except Exception as e:
+                self.log.error(f"Exception in _updateFileAsync", filename=filename, error=e)
+            return
+
+        contents = await self._readJsonFileAsync(filename)
+        contents[key] = value
+        await self._writeJsonFileAsync(filename, contents)
+
+    async def _readJsonFileAsync(self, filename):
         async with self.fileLock:
             try:
                 if os.path.exists(filename):
@@ -406,7 +921,7 @@ class APISessionHandler:
                 self.log.error(f"Exception in _readFileAsync", filename=filename, error=e)
                 return {}
 
-    async def _writeFileAsync(self, filename, contents):
+    async def _writeJsonFileAsync(self, filename, contents):
         async with self.fileLock:
             try:
                 async with aiofiles.open(filename, mode="w", encoding="utf-8") as f:
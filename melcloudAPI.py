@@ -27,8 +27,52 @@ class TimeoutHTTPAdapter(HTTPAdapter):
         return super().send(request, **kwargs)
 
 
+def _reverseTranslate(table):
+    # Melcloud code -> P/M/V/H value, built once when the class is created
+    return {value: key for key, value in table.items()}
+
+
 class Melcloud:
 
+    powerModeTranslate = {
+        0: False,
+        1: True
+    }
+
+    operationModeTranslate = {
+        0: 1,  # Heat
+        1: 3,  # AC
+        2: 8,  # Auto
+        4: 7,  # Fan
+        5: 2   # Dry
+    }
+
+    horizontalVaneTranslate = {
+        0: 0,  # _Auto
+        1: 1,   # Pos 1
+        2: 2,   # Pos 2
+        3: 3,   # Pos 3
+        4: 4,   # Pos 4
+        5: 5,   # Pos 5
+        6: 8,   # Split
+        7: 12   # Swing
+    }
+
+    verticalVaneTranslate = {
+        0: 0,  # _Auto
+        1: 1,   # Pos 1
+        2: 2,   # Pos 2
+        3: 3,   # Pos 3
+        4: 4,   # Pos 4
+        5: 5,   # Pos 5
+        6: 7    # Swing
+    }
+
+    powerModeReverse = _reverseTranslate(powerModeTranslate)
+    operationModeReverse = _reverseTranslate(operationModeTranslate)
+    horizontalVaneReverse = _reverseTranslate(horizontalVaneTranslate)
+    verticalVaneReverse = _reverseTranslate(verticalVaneTranslate)
+
     def __init__(self):
         self.session = requests.Session()
 
@@ -51,40 +95,6 @@ class Melcloud:
             "Cache-Control": "no-cache"
         }
 
-        self.powerModeTranslate = {
-            0: False,
-            1: True
-        }
-
-        self.operationModeTranslate = {
-            0: 1,  # Heat
-            1: 3,  # AC
-            2: 8,  # Auto
-            4: 7,  # Fan
-            5: 2   # Dry
-        }
-
-        self.horizontalVaneTranslate = {
-            0: 0,  # _Auto
-            1: 1,   # Pos 1
-            2: 2,   # Pos 2
-            3: 3,   # Pos 3
-            4: 4,   # Pos 4
-            5: 5,   # Pos 5
-            6: 8,   # Split
-            7: 12   # Swing
-        }
-
-        self.verticalVaneTranslate = {
-            0: 0,  # _Auto
-            1: 1,   # Pos 1
-            2: 2,   # Pos 2
-            3: 3,   # Pos 3
-            4: 4,   # Pos 4
-            5: 5,   # Pos 5
-            6: 7    # Swing
-        }
-
     def login(self, user, password):
 
         data = {
@@ -108,9 +118,9 @@ class Melcloud:
         except Exception as e:
             print(e)
 
-    def _lookupValue(self, di, value):
-        result = [k for k in di.items() if k[1] == value][0][0]
-        return result
+    def _lookupValue(self, reverse, value):
+        # reverse is one of the precomputed *Reverse tables, unknown codes give None
+        return reverse.get(value)
 
     def getDevices(self):
 
@@ -168,12 +178,12 @@ class Melcloud:
             #print(f"H  {self.ata['VaneHorizontal']}")
 
             self.devices[devName]["CurrentState"] = dict()
-            self.devices[devName]["CurrentState"]["P"] = self._lookupValue(self.powerModeTranslate, self.ata["Power"])
-            self.devices[devName]["CurrentState"]["M"] = self._lookupValue(self.operationModeTranslate, self.ata["OperationMode"])
+            self.devices[devName]["CurrentState"]["P"] = self._lookupValue(self.powerModeReverse, self.ata["Power"])
+            self.devices[devName]["CurrentState"]["M"] = self._lookupValue(self.operationModeReverse, self.ata["OperationMode"])
             self.devices[devName]["CurrentState"]["T"] = self.ata["SetTemperature"]
             self.devices[devName]["CurrentState"]["F"] = self.ata["SetFanSpeed"]
-            self.devices[devName]["CurrentState"]["V"] = self._lookupValue(self.verticalVaneTranslate, self.ata["VaneVertical"])
-            self.devices[devName]["CurrentState"]["H"] = self._lookupValue(self.horizontalVaneTranslate, self.ata["VaneHorizontal"])
+            self.devices[devName]["CurrentState"]["V"] = self._lookupValue(self.verticalVaneReverse, self.ata["VaneVertical"])
+            self.devices[devName]["CurrentState"]["H"] = self._lookupValue(self.horizontalVaneReverse, self.ata["VaneHorizontal"])
 
         except Exception as e:
             print(e)
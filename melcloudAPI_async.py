@@ -2,12 +2,73 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-
+import hashlib
+import os
+import random
+import shutil
+import time
+from types import MappingProxyType
+
+import aiohttp
 import arrow
 import structlog
 import ujson
 
-from API.apihandlers import APIMelcloud
+from API.apihandlers import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE_READ, PRIORITY_INTERACTIVE_WRITE, APIMelcloud, SingleFlight
+
+
+def _reverseTranslate(table):
+    # Melcloud code -> P/M/V/H value, built once when the class is created
+    return {value: key for key, value in table.items()}
+
+
+class DeviceEntry:
+    # device registry entry from Listdevices
+
+    __slots__ = ("DeviceID", "BuildingID", "CurrentEnergyConsumed", "LastTimeStamp")
+
+    def __init__(self, DeviceID, BuildingID, CurrentEnergyConsumed=None, LastTimeStamp=None):
+        self.DeviceID = DeviceID
+        self.BuildingID = BuildingID
+        self.CurrentEnergyConsumed = CurrentEnergyConsumed
+        self.LastTimeStamp = LastTimeStamp
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(**{field: data.get(field) for field in cls.__slots__})
+
+    def toDict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class AtaState:
+    # state of one ATA unit, keeps only the modelled Device/Get fields, the rest goes to raw when keepRaw is set
+
+    __slots__ = ("DeviceID", "DeviceType", "EffectiveFlags", "Power", "OperationMode", "SetTemperature", "SetFanSpeed",
+                 "VaneVertical", "VaneHorizontal", "RoomTemperature", "HasPendingCommand", "Offline",
+                 "LastCommunication", "NextCommunication", "raw")
+
+    fields = __slots__[:-1]
+    fieldSet = frozenset(fields)
+
+    @classmethod
+    def fromResponse(cls, data, keepRaw=False):
+        state = cls.__new__(cls)
+        for field in cls.fields:
+            setattr(state, field, data.get(field))
+        if state.EffectiveFlags is None:
+            state.EffectiveFlags = 0
+        state.raw = {key: value for key, value in data.items() if key not in cls.fieldSet} if keepRaw else None
+        return state
+
+    def toSetAta(self):
+        # fields missing from the source payload are left out again
+        out = dict(self.raw) if self.raw else {}
+        for field in self.fields:
+            value = getattr(self, field)
+            if value is not None:
+                out[field] = value
+        return out
 
 
 class Melcloud:
@@ -40,236 +101,660 @@ class Melcloud:
                              5: 5,   # Pos 5
                              6: 7}    # Swing
 
-    devices = {}
-    ata = {}
-    getDevicesLock = asyncio.Lock()
-    setOneDeviceLock = asyncio.Lock()
-    getOneDeviceLock = asyncio.Lock()
-    deviceLock = asyncio.Lock()
-    ataLock = asyncio.Lock()
-    mc = None
-    apiHandler = None
+    powerModeReverse = _reverseTranslate(powerModeTranslate)
+    operationModeReverse = _reverseTranslate(operationModeTranslate)
+    horizontalVaneReverse = _reverseTranslate(horizontalVaneTranslate)
+    verticalVaneReverse = _reverseTranslate(verticalVaneTranslate)
+
+    # desired state key -> (ata field, forward table, reverse table, EffectiveFlags bit), tables are None for plain values
+    stateFields = {"P": ("Power", powerModeTranslate, powerModeReverse, 0x01),
+                   "M": ("OperationMode", operationModeTranslate, operationModeReverse, 0x02),
+                   "T": ("SetTemperature", None, None, 0x04),
+                   "F": ("SetFanSpeed", None, None, 0x08),
+                   "V": ("VaneVertical", verticalVaneTranslate, verticalVaneReverse, 0x10),
+                   "H": ("VaneHorizontal", horizontalVaneTranslate, horizontalVaneReverse, 0x100)}
+
+    # ata field -> keys to look for in the Device object of a Listdevices entry
+    listDevicesAtaFields = {"RoomTemperature": ("RoomTemperature",),
+                            "Power": ("Power",),
+                            "OperationMode": ("OperationMode",),
+                            "SetTemperature": ("SetTemperature",),
+                            "SetFanSpeed": ("SetFanSpeed", "FanSpeed"),
+                            "VaneVertical": ("VaneVertical", "VaneVerticalDirection"),
+                            "VaneHorizontal": ("VaneHorizontal", "VaneHorizontalDirection"),
+                            "HasPendingCommand": ("HasPendingCommand",),
+                            "LastCommunication": ("LastCommunication", "LastTimeStamp")}
+    # Listdevices keys in TIME_ZONE local time, converted to UTC like the Device/Get fields they stand in for
+    listDevicesLocalTimes = {"LastTimeStamp"}
+
+    instances = {}  # accountKey -> Melcloud, one instance per account
+    legacyAdopted = False  # the unsuffixed files of a single account install are taken over once per process
+    sharedConnector = None  # connection pool and DNS cache shared by all accounts
+    MAX_CONCURRENCY = 4
+    COALESCE_WINDOW = 0
+    ATA_MAX_AGE = 60
+    POLL_INTERVAL = 300
+    CONFIRM_TIMEOUT = 10*60
+    CONFIRM_POLL_MIN = 10
+    CONFIRM_POLL_MAX = 60
+    CONFIRM_POLL_GRACE = 5
+    RECONCILE_INTERVAL = 300
+    RECONCILE_RETRY_MIN = 30
+    RECONCILE_RETRY_MAX = 30*60
+    SUBSCRIBER_QUEUE_SIZE = 100
+    KEEP_RAW_ATA = False
     TIME_ZONE = "Europe/Stockholm"
     DATE_FORMAT = "YYYY-MM-DD HH:mm:ss"
-    deviceInfoFileName = "/home/staffan/olis/olis_melcloud/deviceinfofile.txt"
-    deviceFileRead = False
-
-    def __init__(self):
-        pass
+    DATA_DIR = "/home/staffan/olis/olis_melcloud"
+
+    def __init__(self, username=None, accountName=None):
+        self.username = username
+        # every account has its own token, journal and device files, named after accountName or a hash of the username
+        self.accountKey = self._accountKey(username, accountName)
+        suffix = f"_{self.accountKey}" if self.accountKey else ""
+        self.tokenFileName = f"{self.DATA_DIR}/tokenfile{suffix}.txt"
+        self.lastSessionFileName = f"{self.DATA_DIR}/lastsessionfile{suffix}.txt"
+        self.deviceInfoFileName = f"{self.DATA_DIR}/deviceinfofile{suffix}.txt"
+        self.deviceFileRead = False
+        self.persistedDevices = {}  # deviceName -> entry as last written to deviceInfoFileName
+        self.apiHandler = None
+
+        self.devices = {}
+        self.ata = {}
+        # read-only views rebuilt on every write and swapped in one assignment, readers need no lock
+        self.stateSnapshot = MappingProxyType({})
+        self.serverState = {}  # deviceName -> last state published from the server, without optimistic values
+        self.optimistic = {}  # deviceName -> {token: P/M/T/F/V/H values not yet acknowledged by SetAta}
+        self.optimisticTasks = set()
+        self.devicesSnapshot = MappingProxyType({})
+        self.pendingCommands = {}
+        self.ataFetched = {}
+        self.ataNextFetch = {}
+        self.cacheStats = {"hits": 0, "misses": 0, "stale": 0, "notDue": 0}
+        self.getDevicesLock = asyncio.Lock()
+        self.setOneDeviceLocks = {}  # deviceName -> asyncio.Lock, work on different units runs in parallel
+        self.deviceLock = asyncio.Lock()
+        self.ataLock = asyncio.Lock()
+        self.singleFlight = SingleFlight()
+        self.subscribers = set()
+        self.pollerTask = None
+        self.pendingConfirmations = {}  # deviceName -> [(expected P/M/T/F/V/H, future, deadline)]
+        self.confirmTask = None
+        self.targets = {}  # deviceName -> target P/M/T/F/V/H for the reconciler
+        self.reconcileRetry = {}  # deviceName -> (failures, time of next attempt)
+        self.reconcileWake = asyncio.Event()
+        self.reconcileTask = None
+
+    @staticmethod
+    def _accountKey(username, accountName):
+        if accountName:
+            return accountName
+        if username:
+            return hashlib.sha1(username.lower().encode()).hexdigest()[:10]
+        return ""
 
     @classmethod
-    async def create(cls, username, password, commonSession=None):
+    async def create(cls, username, password, commonSession=None, stateStoreFileName=None, accountName=None):
+        # returns the instance for this account, creating it and its APIMelcloud handler on first use
         try:
-            if cls.mc is None:
-                cls.mc = cls()
-                if cls.apiHandler is None:
-                    cls.apiHandler = await APIMelcloud.create(name="Melcloud",
-                                                              commonSession=commonSession,
-                                                              tokenFileName="/home/staffan/olis/olis_melcloud/tokenfile.txt",
-                                                              lastSessionFileName="/home/staffan/olis/olis_melcloud/lastsessionfile.txt",
-                                                              headers={"Content-Type": "application/json",
-                                                                       "Host": "app.melcloud.com",
-                                                                       "Cache-Control": "no-cache"},
-                                                              data={"Email": username,
-                                                                    "Password": password,
-                                                                    "Language": 18,
-                                                                    "AppVersion": "1.32.1.0",
-                                                                    "Persist": False,
-                                                                    "CaptchaResponse": None},
-                                                              loginUrls=["/Mitsubishi.Wifi.Client/Login/ClientLogin"],
-                                                              BASE_URL="https://app.melcloud.com",
-                                                              RETRIES=3,
-                                                              RETRY_DELAY=300,
-                                                              THROTTLE_DELAY=300,
-                                                              THROTTLE_ERROR_DELAY=3*60*60)
-
-                # if await cls.mc.apiHandler.login():
-                #    await cls.mc.getPlant()
-            return cls.mc
+            accountKey = cls._accountKey(username, accountName)
+            if accountKey not in cls.instances:
+                if commonSession is None and cls.sharedConnector is None:
+                    cls.sharedConnector = aiohttp.TCPConnector(ttl_dns_cache=300)
+
+                mc = cls(username=username, accountName=accountName)
+                adoptLegacy = accountName is None and not cls.legacyAdopted
+                if adoptLegacy:
+                    cls.legacyAdopted = True
+                    await asyncio.to_thread(mc._adoptLegacyJournal)
+                mc.apiHandler = await APIMelcloud.create(name=f"Melcloud {accountName or username}",
+                                                         commonSession=commonSession,
+                                                         connector=cls.sharedConnector if commonSession is None else None,
+                                                         stateStoreFileName=stateStoreFileName,
+                                                         tokenFileName=mc.tokenFileName,
+                                                         lastSessionFileName=mc.lastSessionFileName,
+                                                         headers={"Content-Type": "application/json",
+                                                                  "Host": "app.melcloud.com",
+                                                                  "Cache-Control": "no-cache"},
+                                                         data={"Email": username,
+                                                               "Password": password,
+                                                               "Language": 18,
+                                                               "AppVersion": "1.32.1.0",
+                                                               "Persist": False,
+                                                               "CaptchaResponse": None},
+                                                         loginUrls=["/Mitsubishi.Wifi.Client/Login/ClientLogin"],
+                                                         BASE_URL="https://app.melcloud.com",
+                                                         probeUrl="https://app.melcloud.com",
+                                                         RETRIES=3,
+                                                         RETRY_DELAY=300,
+                                                         THROTTLE_DELAY=300,
+                                                         THROTTLE_ERROR_DELAY=3*60*60,
+                                                         MIN_THROTTLE_DELAY=60,
+                                                         MAX_CONCURRENT_REQUESTS=cls.MAX_CONCURRENCY)
+                if mc.apiHandler is None:
+                    return None
+                if adoptLegacy:
+                    await mc._adoptLegacyFiles()
+                cls.instances[accountKey] = mc
+
+                # if await mc.apiHandler.login():
+                #    await mc.getPlant()
+            return cls.instances[accountKey]
 
         except Exception as e:
             cls.log.error(f"Melcloud request error", error=e)
             return None
 
     async def logout(self):
+        self.stopPoller()
+        self.stopConfirmations()
+        self.stopReconciler()
+        self.instances.pop(self.accountKey, None)
         await self.apiHandler.logout()
 
-    @ staticmethod
-    def _lookupValue(di, value):
-        for key, val in di.items():
-            if val == value:
-                return key
-        return None
-
-    @ classmethod
-    async def _getDevice(cls, deviceName=None, subkey=None):
-        async with cls.deviceLock:
-            # if cls.devices is None:
+    def _legacyFileName(self, fileName):
+        # name of the same file before it was suffixed per account
+        return fileName.replace(f"_{self.accountKey}.txt", ".txt")
+
+    def _adoptLegacyJournal(self):
+        # the journal keeps the learned rate and any 429 blackout, read by the handler as soon as it is created
+        legacy = self._legacyFileName(self.lastSessionFileName)
+        if not os.path.exists(self.lastSessionFileName) and os.path.exists(legacy):
+            self.log.warning("Melcloud taking over the unsuffixed session file", fileName=legacy, accountKey=self.accountKey)
+            shutil.copyfile(legacy, self.lastSessionFileName)
+
+    async def _adoptLegacyFiles(self):
+        # token and device registry of an install from before per account files, used when this account has none yet
+        for fileName in (self.tokenFileName, self.deviceInfoFileName):
+            if not await self.apiHandler._readFileAsync(fileName):
+                contents = await self.apiHandler._readFileAsync(self._legacyFileName(fileName))
+                if contents:
+                    self.log.warning("Melcloud taking over the unsuffixed file", fileName=fileName, accountKey=self.accountKey)
+                    await self.apiHandler._writeFileAsync(fileName, contents)
+
+    @classmethod
+    def decodeState(cls, raw):
+        # raw is an AtaState or a Device/Get dict, codes missing from the translate tables decode to None
+        get = raw.get if isinstance(raw, dict) else lambda field: getattr(raw, field, None)
+        out = {}
+        for key, (field, _, reverse, _) in cls.stateFields.items():
+            value = get(field)
+            if reverse is not None and value is not None:
+                decoded = reverse.get(value)
+                if decoded is None:
+                    cls.log.warning("Melcloud unknown code", field=field, value=value)
+                value = decoded
+            out[key] = value
+        return out
+
+    @classmethod
+    def decodeStates(cls, raws):
+        return [cls.decodeState(raw) for raw in raws]
+
+    async def _getDevice(self, deviceName=None, subkey=None):
+        async with self.deviceLock:
+            # if self.devices is None:
             #    return None
 
             # if deviceName is None and subkey is None:
-            #    return cls.devices
+            #    return self.devices
 
             # if deviceName is not None:
             #    if subkey is None:
-            #        return cls.devices[deviceName]
+            #        return self.devices[deviceName]
             #    else:
-            #        return cls.devices[deviceName].get(subkey)
+            #        return self.devices[deviceName].get(subkey)
 
-            if cls.devices is None:
+            if self.devices is None:
                 return None
 
             if deviceName is None:
-                return cls.devices
+                return self.devices
 
-            device = cls.devices.get(deviceName)
+            device = self.devices.get(deviceName)
             if device is None:
                 return None
 
             if subkey is None:
                 return device
 
-            return device.get(subkey)
+            return getattr(device, subkey, None)
 
-    @ classmethod
-    async def _setDevice(cls,  newValue, deviceName=None, subkey=None):
-        async with cls.deviceLock:
+    async def _setDevice(self,  newValue, deviceName=None, subkey=None):
+        async with self.deviceLock:
             if deviceName is not None:
                 if subkey is None:
-                    cls.devices[deviceName] = newValue
+                    self.devices[deviceName] = newValue
                 else:
-                    cls.devices[deviceName][subkey] = newValue
+                    setattr(self.devices[deviceName], subkey, newValue)
             else:
-                cls.devices = newValue
+                self.devices = newValue
+            self.devicesSnapshot = MappingProxyType({name: MappingProxyType(entry.toDict()) for name, entry in (self.devices or {}).items()})
 
-    @ classmethod
-    async def _getAta(cls, deviceName, subkey=None):
-        async with cls.ataLock:
-            if cls.ata is None or deviceName not in cls.ata:
+    async def _getAta(self, deviceName, subkey=None):
+        async with self.ataLock:
+            if self.ata is None or deviceName not in self.ata:
                 return None
             if subkey is None:
-                return cls.ata[deviceName]
+                return self.ata[deviceName]
             else:
-                return cls.ata[deviceName].get(subkey)
+                return getattr(self.ata[deviceName], subkey, None)
 
-    @ classmethod
-    async def _setAta(cls, deviceName, newValue, subkey=None, mask=None):
-        async with cls.ataLock:
+    async def _setAta(self, deviceName, newValue, subkey=None, mask=None):
+        async with self.ataLock:
             if subkey is None:
                 if mask is None:
-                    cls.ata[deviceName] = newValue
+                    self.ata[deviceName] = newValue
+                    self.ataFetched[deviceName] = time.monotonic()
+                    self.ataNextFetch[deviceName] = self._nextUsefulFetch(newValue)
+                    self._publishAta(deviceName, newValue)
                 else:
-                    cls.ata[deviceName] |= mask
+                    self.ata[deviceName] |= mask
             else:
                 if mask is None:
-                    cls.ata[deviceName][subkey] = newValue
+                    setattr(self.ata[deviceName], subkey, newValue)
                 else:
-                    cls.ata[deviceName][subkey] |= mask
+                    setattr(self.ata[deviceName], subkey, getattr(self.ata[deviceName], subkey) | mask)
+
+    def _publishAta(self, deviceName, _ata):
+        # only whole states from the server are published, field edits while building a SetAta are not
+        info = self._buildAtaInfo(_ata)
+        self.serverState[deviceName] = info
+        self._checkConfirmations(deviceName, info)
+        self._publishInfo(deviceName)
+
+    def _publishInfo(self, deviceName, **event):
+        # the published state is the server state with outstanding optimistic values on top, marked as pending,
+        # a unit not fetched yet is published with the optimistic values only
+        previous = self.stateSnapshot.get(deviceName)
+        info = self.serverState.get(deviceName)
+        overlays = self.optimistic.get(deviceName)
+        if overlays:
+            base = info or {"RoomTemp": None, "LastCommunication": None, "CurrentState": {}}
+            currentState = dict(base["CurrentState"])
+            for values in overlays.values():
+                currentState.update(values)
+            info = MappingProxyType({**base, "hasPendingCommand": True, "CurrentState": MappingProxyType(currentState)})
+        if info is not None:
+            self.stateSnapshot = MappingProxyType({**self.stateSnapshot, deviceName: info})
+        elif previous is not None:
+            self.stateSnapshot = MappingProxyType({name: value for name, value in self.stateSnapshot.items() if name != deviceName})
+
+        changes = self._diffInfo(previous, info)
+        if changes or event:
+            self._emit({"deviceName": deviceName, "changes": changes, **event})
+            if deviceName in self.targets:
+                self.reconcileWake.set()
+
+    @staticmethod
+    def _flattenInfo(info):
+        if info is None:
+            return {}
+        return {"RoomTemp": info["RoomTemp"],
+                "hasPendingCommand": info["hasPendingCommand"],
+                **info["CurrentState"]}
 
-    @ classmethod
-    async def getDevices(cls):
+    @classmethod
+    def _diffInfo(cls, previous, current):
+        # fields of current that differ from previous, everything for the first state of a device
+        previous = cls._flattenInfo(previous)
+        return {key: value for key, value in cls._flattenInfo(current).items() if key not in previous or previous[key] != value}
+
+    def _emit(self, event):
+        for queue in self.subscribers:
+            if queue.full():  # a slow subscriber loses its oldest events, not the newest
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def subscribe(self, deviceNames=None):
+        # async iterator of {"deviceName": ..., "changes": {...}} events, optionally for some devices only
+        # (a rolled back optimistic command adds "rollback": True and its desiredState)
+        queue = asyncio.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(queue)
         try:
-            async with cls.getDevicesLock:
-                if await cls._getDevice():  # exit if devices already set
-                    return
+            while True:
+                event = await queue.get()
+                if deviceNames is None or event["deviceName"] in deviceNames:
+                    yield event
+        finally:
+            self.subscribers.discard(queue)
+
+    def startPoller(self, interval=None, jitter=0.1, bulkState=False):
+        if self.pollerTask is None or self.pollerTask.done():
+            self.pollerTask = asyncio.create_task(self._pollLoop(interval or self.POLL_INTERVAL, jitter, bulkState))
+
+    def stopPoller(self):
+        if self.pollerTask is not None:
+            self.pollerTask.cancel()
+            self.pollerTask = None
+
+    async def _pollLoop(self, interval, jitter, bulkState):
+        # keeps the ata cache fresh as background work, units fetched recently or not due to report are skipped
+        while True:
+            try:
+                # maxAge stays well below the shortest jittered sleep, so only units fetched by someone else since
+                # the last cycle are skipped and not the ones this loop fetched itself
+                maxAge = interval * (1 - jitter) / 2
+                result = await self.refreshAllDevices(bulkState=bulkState, maxAge=maxAge, priority=PRIORITY_BACKGROUND, maxWait=interval)
+                if result["errors"]:
+                    self.log.warning("Melcloud poller refresh incomplete", errors=result["errors"])
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                self.log.error("Exception in _pollLoop", error=e)
+
+            # never poll faster than the handler's learned throttle delay
+            delay = max(interval, self.apiHandler.rateLimiter.delay)
+            await asyncio.sleep(delay * random.uniform(1 - jitter, 1 + jitter))
+
+    def setTarget(self, deviceName, targetState):
+        # declarative alternative to setOneDeviceInfo, the reconciler only sends the fields that drift from the target
+        target = {key: value for key, value in targetState.items() if key in self.stateFields and value is not None}
+        if self.targets.get(deviceName) != target:
+            self.targets[deviceName] = target
+            self.reconcileRetry.pop(deviceName, None)
+        if self.reconcileTask is None or self.reconcileTask.done():
+            self.reconcileTask = asyncio.create_task(self._reconcileLoop())
+        self.reconcileWake.set()
+
+    def clearTarget(self, deviceName):
+        self.targets.pop(deviceName, None)
+        self.reconcileRetry.pop(deviceName, None)
+
+    def stopReconciler(self):
+        if self.reconcileTask is not None:
+            self.reconcileTask.cancel()
+            self.reconcileTask = None
+
+    def _drift(self, deviceName, info):
+        # target fields that differ from the published state, None while the unit still has a command pending
+        if info is None or info["hasPendingCommand"]:
+            return None
+        return {key: value for key, value in self.targets.get(deviceName, {}).items() if info["CurrentState"].get(key) != value}
+
+    async def _reconcileOne(self, deviceName):
+        info = await self.getOneDeviceInfo(deviceName, priority=PRIORITY_BACKGROUND)
+        drift = self._drift(deviceName, info)
+        if not drift:
+            # nothing to send, an earlier failure no longer needs a retry
+            self.reconcileRetry.pop(deviceName, None)
+            return
+
+        self.log.info("Melcloud reconciling drift", deviceName=deviceName, drift=drift)
+        if await self.setOneDeviceInfo(deviceName, drift) == "OK":
+            self.reconcileRetry.pop(deviceName, None)
+        else:
+            failures = self.reconcileRetry.get(deviceName, (0, 0))[0] + 1
+            delay = min(self.RECONCILE_RETRY_MIN * 2 ** (failures - 1), self.RECONCILE_RETRY_MAX)
+            self.reconcileRetry[deviceName] = (failures, time.time() + delay)
+            self.log.warning("Melcloud reconcile failed", deviceName=deviceName, failures=failures, retryIn=delay)
+
+    async def _reconcileLoop(self):
+        # runs on setTarget, on change events for a targeted device and every RECONCILE_INTERVAL,
+        # devices backing off after a failed send are left alone until their retry time
+        while True:
+            try:
+                self.reconcileWake.clear()
+                now = time.time()
+                due = [deviceName for deviceName in self.targets if self.reconcileRetry.get(deviceName, (0, 0))[1] <= now]
+                results = await asyncio.gather(*[self._reconcileOne(deviceName) for deviceName in due], return_exceptions=True)
+                for deviceName, result in zip(due, results):
+                    if isinstance(result, BaseException):
+                        self.log.error("Exception in _reconcileOne", deviceName=deviceName, error=result)
+
+                timeout = self.RECONCILE_INTERVAL
+                now = time.time()
+                for _, retryAt in self.reconcileRetry.values():
+                    if retryAt > now:
+                        timeout = min(timeout, retryAt - now)
+                try:
+                    await asyncio.wait_for(self.reconcileWake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                self.log.error("Exception in _reconcileLoop", error=e)
+                await asyncio.sleep(self.RECONCILE_RETRY_MIN)
 
-                if not cls.deviceFileRead:
-                    _deviceFromFile = await cls.apiHandler._readFileAsync(cls.deviceInfoFileName)
+    @classmethod
+    def _buildAtaInfo(cls, _ata):
+        return MappingProxyType({"RoomTemp": _ata.RoomTemperature,
+                                 "LastCommunication": arrow.get(_ata.LastCommunication).to(cls.TIME_ZONE).format(cls.DATE_FORMAT) if _ata.LastCommunication else None,
+                                 "hasPendingCommand": _ata.HasPendingCommand,
+                                 "CurrentState": MappingProxyType(cls.decodeState(_ata))})
 
-                if not cls.deviceFileRead and _deviceFromFile:
-                    cls.log.info("Melcloud setting devices from file")
-                    cls.deviceFileRead = True
-                    await cls._setDevice(_deviceFromFile.get("devices"))
+    @classmethod
+    def _thaw(cls, value):
+        # plain dict copy of a published view, the async read APIs return these so callers can serialize and edit them
+        if isinstance(value, MappingProxyType):
+            return {key: cls._thaw(item) for key, item in value.items()}
+        return value
+
+    def snapshot(self, deviceName=None):
+        # synchronous, lock free read of the last published state, read-only views (use the async getters for dicts)
+        if deviceName is None:
+            return self.stateSnapshot
+        return self.stateSnapshot.get(deviceName)
+
+    @staticmethod
+    def _deviceLock(locks, deviceName):
+        if deviceName not in locks:
+            locks[deviceName] = asyncio.Lock()
+        return locks[deviceName]
+
+    async def _ataFresh(self, deviceName, maxAge=None):
+        # read-through cache check, counts hits, misses and stale entries in cacheStats
+        maxAge = self.ATA_MAX_AGE if maxAge is None else maxAge
+        fetched = self.ataFetched.get(deviceName)
+        if fetched is None or not await self._getAta(deviceName):
+            self.cacheStats["misses"] += 1
+            return False
 
-                else:
-                    cls.log.info("Melcloud trying getDevices")
-                    entries = await cls.apiHandler.doSession(method="GET", url="/Mitsubishi.Wifi.Client/User/Listdevices")
+        if time.monotonic() - fetched > maxAge:
+            if time.time() < self.ataNextFetch.get(deviceName, 0):
+                # the unit has not checked in since the last fetch, the cloud has nothing newer
+                self.cacheStats["notDue"] += 1
+                return True
+            self.cacheStats["stale"] += 1
+            return False
 
-                    allDevices = []
-                    for entry in entries:
-                        allDevices += entry["Structure"]["Devices"]
+        self.cacheStats["hits"] += 1
+        return True
 
-                        for area in entry["Structure"]["Areas"]:
-                            allDevices += area["Devices"]
+    @staticmethod
+    def _nextUsefulFetch(ataValue):
+        # epoch time of the unit's next check-in from the NextCommunication field (UTC), 0 if unknown
+        try:
+            if ataValue and ataValue.NextCommunication:
+                return arrow.get(ataValue.NextCommunication).timestamp()
+        except (arrow.parser.ParserError, TypeError, ValueError):
+            pass
+        return 0
 
-                        for floor in entry["Structure"]["Floors"]:
-                            allDevices += floor["Devices"]
-                            for area in floor["Areas"]:
-                                allDevices += area["Devices"]
+    def getCacheStats(self):
+        return dict(self.cacheStats)
 
-                    for dev in allDevices:
-                        deviceName = dev["DeviceName"]
-                        await cls._setDevice({"DeviceID": dev["DeviceID"],
-                                             "BuildingID": dev["BuildingID"],
-                                              "CurrentEnergyConsumed": dev["Device"]["CurrentEnergyConsumed"],
-                                              "LastTimeStamp": arrow.get(dev["Device"]["LastTimeStamp"]).format(cls.DATE_FORMAT)},
-                                             deviceName)
+    async def _listDevices(self, priority=PRIORITY_INTERACTIVE_READ):
+        entries = await self.apiHandler.doSession(method="GET", url="/Mitsubishi.Wifi.Client/User/Listdevices", priority=priority)
+        if entries is None:
+            raise RuntimeError("no reply from User/Listdevices")
 
-                        cls.log.info("Melcloud writing devices to file")
-                        await cls.apiHandler._writeFileAsync(cls.deviceInfoFileName, {"devices": cls.devices})
+        allDevices = []
+        for entry in entries:
+            allDevices += entry["Structure"]["Devices"]
 
-        except Exception as e:
-            cls.log.error("Exception in getDevices", error=e)
+            for area in entry["Structure"]["Areas"]:
+                allDevices += area["Devices"]
+
+            for floor in entry["Structure"]["Floors"]:
+                allDevices += floor["Devices"]
+                for area in floor["Areas"]:
+                    allDevices += area["Devices"]
+
+        return allDevices
+
+    @classmethod
+    def _decodeListDevice(cls, dev):
+        # returns the ata fields found in a Listdevices entry and the names of the ones missing
+        _ata = {"DeviceID": dev["DeviceID"],
+                "EffectiveFlags": 0}
+        missing = []
+        for field, sourceKeys in cls.listDevicesAtaFields.items():
+            for sourceKey in sourceKeys:
+                if dev["Device"].get(sourceKey) is not None:
+                    _ata[field] = dev["Device"][sourceKey]
+                    if sourceKey in cls.listDevicesLocalTimes:
+                        _ata[field] = arrow.get(_ata[field], tzinfo=cls.TIME_ZONE).to("UTC").format("YYYY-MM-DDTHH:mm:ss")
+                    break
+            else:
+                missing.append(field)
+        return _ata, missing
 
-    @ classmethod
-    async def getOneDevice(cls, deviceName):
+    async def getDevices(self, bulkState=False, priority=PRIORITY_INTERACTIVE_READ):
+        # shared here as well as in apiHandler, callers queued on getDevicesLock would otherwise run Listdevices again
+        return await self.singleFlight.do(("getDevices", bulkState, priority), lambda: self._getDevices(bulkState, priority))
+
+    async def _getDevices(self, bulkState=False, priority=PRIORITY_INTERACTIVE_READ):
+        # with bulkState the full state of every unit is decoded from the Listdevices reply,
+        # returns the device names that still need a Device/Get, None when Listdevices failed
         try:
-            async with cls.getOneDeviceLock:
-                cls.log.info("Melcloud trying getOneDevice")
+            async with self.getDevicesLock:
+                if not bulkState and await self._getDevice():  # exit if devices already set
+                    return []
+
+                if not bulkState and not self.deviceFileRead:
+                    _deviceFromFile = await self.apiHandler._readFileAsync(self.deviceInfoFileName)
+
+                if not bulkState and not self.deviceFileRead and _deviceFromFile:
+                    self.log.info("Melcloud setting devices from file")
+                    self.deviceFileRead = True
+                    if set(_deviceFromFile) == {"devices"}:
+                        # file from before one key per device, rewritten in the new layout
+                        _deviceFromFile = _deviceFromFile["devices"]
+                        await self.apiHandler._writeFileAsync(self.deviceInfoFileName, _deviceFromFile)
+                    self.persistedDevices = dict(_deviceFromFile)
+                    await self._setDevice({deviceName: DeviceEntry.fromDict(entry) for deviceName, entry in _deviceFromFile.items()})
+                    return []
+
+                self.log.info("Melcloud trying getDevices", bulkState=bulkState)
+                incomplete = []
+                for dev in await self._listDevices(priority=priority):
+                    deviceName = dev["DeviceName"]
+                    await self._setDevice(DeviceEntry(DeviceID=dev["DeviceID"],
+                                                     BuildingID=dev["BuildingID"],
+                                                     CurrentEnergyConsumed=dev["Device"]["CurrentEnergyConsumed"],
+                                                     LastTimeStamp=arrow.get(dev["Device"]["LastTimeStamp"]).format(self.DATE_FORMAT)),
+                                         deviceName)
+
+                    if bulkState:
+                        _ata, missing = self._decodeListDevice(dev)
+                        if missing:
+                            self.log.info("Melcloud Listdevices entry lacks fields", deviceName=deviceName, missing=missing)
+                            incomplete.append(deviceName)
+                        else:
+                            await self._setAta(deviceName, AtaState.fromResponse(_ata))
+
+                # one key per device, only the entries that changed since the last write are stored
+                for deviceName, entry in self.devices.items():
+                    entry = entry.toDict()
+                    if self.persistedDevices.get(deviceName) != entry:
+                        self.log.info("Melcloud writing device to file", deviceName=deviceName)
+                        await self.apiHandler._updateFileAsync(self.deviceInfoFileName, deviceName, entry)
+                        self.persistedDevices[deviceName] = entry
+                return incomplete
+
+        except Exception as e:
+            self.log.error("Exception in getDevices", error=e)
+            return None
+
+    async def _fetchOneDevice(self, deviceName, priority=PRIORITY_INTERACTIVE_READ, maxWait=None):
+        # concurrent reads of the same unit share one Device/Get in apiHandler.doSession
+        params = {"id": await self._getDevice(deviceName, subkey='DeviceID'),
+                  "buildingID": await self._getDevice(deviceName, subkey='BuildingID')}
+        if params["id"] is None:
+            raise KeyError(f"unknown device {deviceName}")
 
-                await cls.getDevices()
+        _result = await self.apiHandler.doSession(method="GET", url="/Mitsubishi.Wifi.Client/Device/Get", params=params, priority=priority, maxWait=maxWait)
+        if _result is None:
+            raise RuntimeError("no reply from Device/Get")
+        await self._setAta(deviceName, AtaState.fromResponse(_result, keepRaw=self.KEEP_RAW_ATA))
 
-                params = {"id": await cls._getDevice(deviceName, subkey='DeviceID'),
-                          "buildingID": await cls._getDevice(deviceName, subkey='BuildingID')}
+    async def getOneDevice(self, deviceName, priority=PRIORITY_INTERACTIVE_READ):
+        try:
+            self.log.info("Melcloud trying getOneDevice")
 
-                _result = await cls.apiHandler.doSession(method="GET", url="/Mitsubishi.Wifi.Client/Device/Get", params=params)
-                await cls._setAta(deviceName, _result)
-                cls.log.info("Melcloud finished getOneDevice")
+            await self.getDevices(priority=priority)
+            await self._fetchOneDevice(deviceName, priority=priority)
+            self.log.info("Melcloud finished getOneDevice")
 
         except Exception as e:
-            cls.log.error("Exception in getOneDevice", deviceName=deviceName, error=e)
+            self.log.error("Exception in getOneDevice", deviceName=deviceName, error=e)
 
-    @classmethod
-    async def getAllDevice(cls):
-        await cls.getDevices()
+    async def getAllDevice(self, maxAge=None, forceRefresh=False, priority=PRIORITY_INTERACTIVE_READ):
+        await self.getDevices()
         out = {}
-        _dev = await cls._getDevice()
+        _dev = await self._getDevice()
         for dev in _dev:
-            out[dev] = await cls.getOneDeviceInfo(dev)
+            out[dev] = await self.getOneDeviceInfo(dev, maxAge=maxAge, forceRefresh=forceRefresh, priority=priority)
         return out
 
-    @classmethod
-    async def getOneDeviceInfo(cls, deviceName):
-        # if not await cls._getAta(deviceName):
-        await cls.getOneDevice(deviceName)
+    async def refreshAllDevices(self, maxConcurrency=None, bulkState=False, maxAge=0, priority=PRIORITY_BACKGROUND, maxWait=None):
+        # fan out Device/Get for every unit, MAX_CALLS/THROTTLE_DELAY are still enforced by apiHandler.doSession
+        # with bulkState one Listdevices call fills the ata cache and Device/Get is only used for incomplete entries
+        # runs as background work by default, maxWait drops fetches that could not get a rate limited slot in time
+        incomplete = await self.getDevices(bulkState=bulkState, priority=priority)
+        if bulkState and incomplete is None:
+            # Listdevices failed, the cached states were not refreshed by it so every unit falls back to Device/Get
+            self.log.warning("Melcloud bulk refresh failed, falling back to Device/Get")
+            bulkState = False
+        _dev = await self._getDevice() or {}
+        semaphore = asyncio.Semaphore(maxConcurrency or self.MAX_CONCURRENCY)
+
+        async def _refreshOne(deviceName):
+            if bulkState and deviceName not in incomplete and await self._getAta(deviceName):
+                pass
+            elif not await self._ataFresh(deviceName, maxAge):
+                async with semaphore:
+                    await self._fetchOneDevice(deviceName, priority=priority, maxWait=maxWait)
+            return await self._returnOneAtaInfo(deviceName)
+
+        deviceNames = list(_dev)
+        results = await asyncio.gather(*[_refreshOne(dev) for dev in deviceNames], return_exceptions=True)
+
+        out = {"devices": {}, "errors": {}}
+        for deviceName, result in zip(deviceNames, results):
+            if isinstance(result, BaseException):
+                self.log.warning("Melcloud refreshAllDevices failed for device", deviceName=deviceName, error=result)
+                out["errors"][deviceName] = f"{type(result).__name__}: {result}"
+            else:
+                out["devices"][deviceName] = result
+        return out
 
-        return await cls._returnOneAtaInfo(deviceName)
+    async def getOneDeviceInfo(self, deviceName, maxAge=None, forceRefresh=False, priority=PRIORITY_INTERACTIVE_READ):
+        # served from the ata cache when it is younger than maxAge seconds (default ATA_MAX_AGE)
+        if forceRefresh or not await self._ataFresh(deviceName, maxAge):
+            await self.getOneDevice(deviceName, priority=priority)
 
-    @classmethod
-    async def getDevicesInfo(cls):
-        return await cls._getDevice()
+        return await self._returnOneAtaInfo(deviceName)
 
-    @classmethod
-    async def _returnOneAtaInfo(cls, deviceName):
-        return {"RoomTemp": await cls._getAta(deviceName, subkey="RoomTemperature"),
-                "LastCommunication": arrow.get(await cls._getAta(deviceName, subkey="LastCommunication")).to(cls.TIME_ZONE).format(cls.DATE_FORMAT),
-                "hasPendingCommand": await cls._getAta(deviceName, subkey="HasPendingCommand"),
-                "CurrentState": {"P": cls._lookupValue(cls.powerModeTranslate, await cls._getAta(deviceName, subkey="Power")),
-                                 "M": cls._lookupValue(cls.operationModeTranslate, await cls._getAta(deviceName, subkey="OperationMode")),
-                                 "T": await cls._getAta(deviceName, subkey="SetTemperature"),
-                                 "F": await cls._getAta(deviceName, subkey="SetFanSpeed"),
-                                 "V": cls._lookupValue(cls.verticalVaneTranslate, await cls._getAta(deviceName, subkey="VaneVertical")),
-                                 "H": cls._lookupValue(cls.horizontalVaneTranslate, await cls._getAta(deviceName, subkey="VaneHorizontal"))}}
+    async def getDevicesInfo(self):
+        return self._thaw(self.devicesSnapshot)
 
-    @classmethod
-    async def printDevicesInfo(cls):
-        _dev = await cls._getDevice()
+    async def _returnOneAtaInfo(self, deviceName):
+        return self._thaw(self.snapshot(deviceName))
+
+    async def printDevicesInfo(self):
+        _dev = await self._getDevice()
         for dev in _dev:
-            cls.printOneDevicesInfo(dev)
+            self.printOneDevicesInfo(dev)
 
-    @classmethod
-    async def printOneDevicesInfo(cls, deviceName):
-        _dev = await cls._getDevice()
+    async def printOneDevicesInfo(self, deviceName):
+        _dev = await self._getDevice()
         print(f"{deviceName} :")
         print(f"DeviceID: {_dev['DeviceID']}")
         print(f"BuildingID: {_dev['BuildingID']}")
@@ -280,50 +765,245 @@ class Melcloud:
         print(f"hasPendingCommand: {_dev['hasPendingCommand']}")
         print("\n")
 
-    @classmethod
-    async def setOneDeviceInfo(cls, deviceName, desiredState):
+    async def _sendOneDeviceInfo(self, deviceName, desiredState):
         try:
-            async with cls.setOneDeviceLock:
-                cls.log.info("Melcloud trying setOneDeviceInfo")
-
-                if not await cls._getAta(deviceName):
-                    await cls.getOneDevice(deviceName)
-
-                # await cls.apiHandler._validateToken()
-
-                # Melcloud.ata[deviceName]["DeviceID"] = Melcloud.devices[deviceName]["DeviceID"]
-                if desiredState.get("P") is not None:
-                    await cls._setAta(deviceName, cls.powerModeTranslate[desiredState["P"]], subkey="Power")
-                    await cls._setAta(deviceName, newValue=None, mask=0x01, subkey="EffectiveFlags")
-
-                if desiredState.get("M") is not None:
-                    await cls._setAta(deviceName, cls.operationModeTranslate[desiredState["M"]], subkey="OperationMode")
-                    await cls._setAta(deviceName, newValue=None, mask=0x02, subkey="EffectiveFlags")
-
-                if desiredState.get("T") is not None:
-                    await cls._setAta(deviceName, desiredState["T"], subkey="SetTemperature")
-                    await cls._setAta(deviceName, newValue=None, mask=0x04, subkey="EffectiveFlags")
-
-                if desiredState.get("F") is not None:
-                    await cls._setAta(deviceName, desiredState["F"], subkey="SetFanSpeed")
-                    await cls._setAta(deviceName, newValue=None, mask=0x08, subkey="EffectiveFlags")
-
-                if desiredState.get("V") is not None:
-                    await cls._setAta(deviceName, cls.verticalVaneTranslate[desiredState["V"]], subkey="VaneVertical")
-                    await cls._setAta(deviceName, newValue=None, mask=0x10, subkey="EffectiveFlags")
-
-                if desiredState.get("H") is not None:
-                    await cls._setAta(deviceName, cls.horizontalVaneTranslate[desiredState["H"]], subkey="VaneHorizontal")
-                    await cls._setAta(deviceName, newValue=None, mask=0x100, subkey="EffectiveFlags")
-
-                _result = await cls.apiHandler.doSession(method="POST", url="/Mitsubishi.Wifi.Client/Device/SetAta", data=ujson.dumps(cls.ata[deviceName]))
-                await cls._setAta(deviceName, _result)
-                cls.log.info("Melcloud finished setOneDeviceInfo")
-
-                await cls._setAta(deviceName, 0, subkey="EffectiveFlags")
+            async with self._deviceLock(self.setOneDeviceLocks, deviceName):
+                self.log.info("Melcloud trying setOneDeviceInfo")
+
+                if not await self._getAta(deviceName):
+                    await self.getOneDevice(deviceName, priority=PRIORITY_INTERACTIVE_WRITE)
+
+                # await self.apiHandler._validateToken()
+
+                # the payload is built from a copy so a concurrent Device/Get cannot interleave with the edits
+                payload = (await self._getAta(deviceName)).toSetAta()
+                payload["EffectiveFlags"] = 0
+                for key, (field, forward, _, flag) in self.stateFields.items():
+                    if desiredState.get(key) is not None:
+                        payload[field] = forward[desiredState[key]] if forward is not None else desiredState[key]
+                        payload["EffectiveFlags"] |= flag
+
+                _result = await self.apiHandler.doSession(method="POST", url="/Mitsubishi.Wifi.Client/Device/SetAta", data=ujson.dumps(payload), priority=PRIORITY_INTERACTIVE_WRITE)
+                if _result is None:
+                    raise RuntimeError("no reply from Device/SetAta")
+                _ata = AtaState.fromResponse(_result, keepRaw=self.KEEP_RAW_ATA)
+                _ata.EffectiveFlags = 0
+                await self._setAta(deviceName, _ata)
+                self.log.info("Melcloud finished setOneDeviceInfo")
 
                 return "OK"
 
         except Exception as e:
-            cls.log.error("Exception in setOneDeviceInfo", deviceName=deviceName, error=e)
+            self.log.error("Exception in setOneDeviceInfo", deviceName=deviceName, error=e)
             return False
+
+    async def _flushPendingCommand(self, deviceName, window):
+        await asyncio.sleep(window)
+        pending = self.pendingCommands.pop(deviceName)
+        self.log.info("Melcloud sending coalesced command", deviceName=deviceName, desiredState=pending["state"], callers=pending["callers"])
+        try:
+            pending["future"].set_result(await self._sendOneDeviceInfo(deviceName, pending["state"]))
+        except BaseException as e:
+            pending["future"].set_exception(e)
+            raise
+
+    async def setOneDeviceInfo(self, deviceName, desiredState, coalesce=None, confirm=False, confirmTimeout=None, optimistic=False):
+        # with a coalesce window (seconds) desired states for the same device are merged into one SetAta request
+        # with confirm an accepted command returns a future instead of "OK", it resolves True when the unit reports
+        # the requested values without a pending command and False when confirmTimeout (CONFIRM_TIMEOUT) passes first
+        # with optimistic the values are published at once as pending and the returned task sends them, a failed
+        # send rolls them back and emits an event with "rollback": True
+        if optimistic:
+            return self._setOptimistic(deviceName, desiredState, coalesce, confirm, confirmTimeout)
+
+        result = await self._setOneDeviceInfo(deviceName, desiredState, coalesce)
+        if confirm and result == "OK":
+            return self._addConfirmation(deviceName, desiredState, confirmTimeout or self.CONFIRM_TIMEOUT)
+        return result
+
+    async def _setOneDeviceInfo(self, deviceName, desiredState, coalesce=None):
+        window = self.COALESCE_WINDOW if coalesce is None else coalesce
+        if not window:
+            return await self._sendOneDeviceInfo(deviceName, desiredState)
+
+        pending = self.pendingCommands.get(deviceName)
+        if pending is None:
+            pending = {"state": {},
+                       "callers": 0,
+                       "future": asyncio.get_running_loop().create_future()}
+            self.pendingCommands[deviceName] = pending
+            pending["task"] = asyncio.create_task(self._flushPendingCommand(deviceName, window))
+
+        pending["state"].update({key: value for key, value in desiredState.items() if value is not None})
+        pending["callers"] += 1
+        return await asyncio.shield(pending["future"])
+
+    def _setOptimistic(self, deviceName, desiredState, coalesce, confirm, confirmTimeout):
+        values = {key: value for key, value in desiredState.items() if key in self.stateFields and value is not None}
+        token = object()
+        self.optimistic.setdefault(deviceName, {})[token] = values
+        self._publishInfo(deviceName)
+
+        task = asyncio.create_task(self._sendOptimistic(deviceName, desiredState, token, coalesce, confirm, confirmTimeout))
+        self.optimisticTasks.add(task)
+        task.add_done_callback(self.optimisticTasks.discard)
+        return task
+
+    async def _sendOptimistic(self, deviceName, desiredState, token, coalesce, confirm, confirmTimeout):
+        result = False
+        try:
+            result = await self.setOneDeviceInfo(deviceName, desiredState, coalesce, confirm, confirmTimeout)
+            return result
+
+        finally:
+            # on success the SetAta reply is already the server state, on failure the values are dropped
+            overlays = self.optimistic.get(deviceName, {})
+            overlays.pop(token, None)
+            if not overlays:
+                self.optimistic.pop(deviceName, None)
+            if result:
+                self._publishInfo(deviceName)
+            else:
+                self.log.warning("Melcloud optimistic command rolled back", deviceName=deviceName, desiredState=desiredState)
+                self._publishInfo(deviceName, rollback=True, desiredState=desiredState)
+
+    def _addConfirmation(self, deviceName, desiredState, timeout):
+        future = asyncio.get_running_loop().create_future()
+        expected = {key: value for key, value in desiredState.items() if key in self.stateFields and value is not None}
+        confirmations = []
+        for olderExpected, olderFuture, olderDeadline in self.pendingConfirmations.get(deviceName, []):
+            # a newer command overrides the same fields, the older one can only be confirmed on what is left
+            olderExpected = {key: value for key, value in olderExpected.items() if key not in expected}
+            if olderFuture.done():
+                continue
+            if not olderExpected:
+                olderFuture.set_result(False)
+            else:
+                confirmations.append((olderExpected, olderFuture, olderDeadline))
+        confirmations.append((expected, future, time.time() + timeout))
+        self.pendingConfirmations[deviceName] = confirmations
+        if self.confirmTask is None or self.confirmTask.done():
+            self.confirmTask = asyncio.create_task(self._confirmLoop())
+        return future
+
+    def _checkConfirmations(self, deviceName, info):
+        confirmations = self.pendingConfirmations.get(deviceName)
+        if not confirmations or info["hasPendingCommand"]:
+            return
+
+        remaining = []
+        for expected, future, deadline in confirmations:
+            if future.done():
+                continue
+            if all(info["CurrentState"].get(key) == value for key, value in expected.items()):
+                future.set_result(True)
+            else:
+                remaining.append((expected, future, deadline))
+        if remaining:
+            self.pendingConfirmations[deviceName] = remaining
+        else:
+            del self.pendingConfirmations[deviceName]
+
+    def stopConfirmations(self):
+        # outstanding confirmations resolve False
+        if self.confirmTask is not None:
+            self.confirmTask.cancel()
+            self.confirmTask = None
+        for confirmations in self.pendingConfirmations.values():
+            for _, future, _ in confirmations:
+                if not future.done():
+                    future.set_result(False)
+        self.pendingConfirmations = {}
+
+    async def _confirmLoop(self):
+        # one poll loop for all outstanding confirmations, a unit is polled just after its NextCommunication
+        # when that is known, otherwise with a backoff from CONFIRM_POLL_MIN up to CONFIRM_POLL_MAX
+        backoff = self.CONFIRM_POLL_MIN
+        while self.pendingConfirmations:
+            try:
+                now = time.time()
+                for deviceName in list(self.pendingConfirmations):
+                    remaining = []
+                    for expected, future, deadline in self.pendingConfirmations[deviceName]:
+                        if future.done():
+                            continue
+                        if deadline <= now:
+                            self.log.warning("Melcloud command not confirmed before deadline", deviceName=deviceName, desiredState=expected)
+                            future.set_result(False)
+                        else:
+                            remaining.append((expected, future, deadline))
+                    if remaining:
+                        self.pendingConfirmations[deviceName] = remaining
+                    else:
+                        del self.pendingConfirmations[deviceName]
+                if not self.pendingConfirmations:
+                    break
+
+                dueAt = {}
+                for deviceName in self.pendingConfirmations:
+                    nextCommunication = self.ataNextFetch.get(deviceName, 0)
+                    dueAt[deviceName] = nextCommunication + self.CONFIRM_POLL_GRACE if nextCommunication > now else now + backoff
+                nextDeadline = min(deadline for confirmations in self.pendingConfirmations.values() for _, _, deadline in confirmations)
+                wakeAt = min(min(dueAt.values()), nextDeadline)
+                await asyncio.sleep(max(0, wakeAt - now))
+
+                now = time.time()
+                due = [deviceName for deviceName, at in dueAt.items() if at <= now and deviceName in self.pendingConfirmations]
+                if due:
+                    results = await asyncio.gather(*[self._fetchOneDevice(deviceName, priority=PRIORITY_INTERACTIVE_READ) for deviceName in due], return_exceptions=True)
+                    for deviceName, result in zip(due, results):
+                        if isinstance(result, BaseException):
+                            self.log.warning("Melcloud confirmation poll failed", deviceName=deviceName, error=result)
+                    backoff = min(backoff * 1.5, self.CONFIRM_POLL_MAX)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                self.log.error("Exception in _confirmLoop", error=e)
+                await asyncio.sleep(backoff)
+
+    async def setManyDevices(self, desiredStates, maxConcurrency=None, maxWait=None):
+        # one scene across several units, {deviceName: desiredState} -> {"devices": {deviceName: "OK"}, "errors": {...}}
+        # units without a cached state get it from parallel Device/Get calls before any write, units that have one
+        # keep it, the SetAta calls then run concurrently as interactive writes within apiHandler's rate budget
+        out = {"devices": {}, "errors": {}}
+        semaphore = asyncio.Semaphore(maxConcurrency or self.MAX_CONCURRENCY)
+
+        async def _prefetchOne(deviceName):
+            if not await self._getAta(deviceName):
+                async with semaphore:
+                    await self._fetchOneDevice(deviceName, priority=PRIORITY_INTERACTIVE_WRITE, maxWait=maxWait)
+
+        async def _sendOne(deviceName):
+            async with semaphore:
+                return await self._sendOneDeviceInfo(deviceName, desiredStates[deviceName])
+
+        deviceNames = list(desiredStates)
+        try:
+            missing = [deviceName for deviceName in deviceNames if not await self._getAta(deviceName)]
+            if missing:  # the device registry is needed for the Device/Get parameters
+                await self.getDevices(priority=PRIORITY_INTERACTIVE_WRITE)
+        except Exception as e:
+            self.log.error("Exception in setManyDevices", error=e)
+
+        results = await asyncio.gather(*[_prefetchOne(dev) for dev in deviceNames], return_exceptions=True)
+        ready = []
+        for deviceName, result in zip(deviceNames, results):
+            if isinstance(result, BaseException):
+                out["errors"][deviceName] = f"{type(result).__name__}: {result}"
+            else:
+                ready.append(deviceName)
+
+        results = await asyncio.gather(*[_sendOne(dev) for dev in ready], return_exceptions=True)
+        for deviceName, result in zip(ready, results):
+            if isinstance(result, BaseException):
+                out["errors"][deviceName] = f"{type(result).__name__}: {result}"
+            elif result != "OK":
+                out["errors"][deviceName] = "SetAta failed"
+            else:
+                out["devices"][deviceName] = result
+
+        if out["errors"]:
+            self.log.warning("Melcloud setManyDevices incomplete", errors=out["errors"])
+        return out
@@ -0,0 +1,98 @@
+import asyncio
+import copy
+import os
+import sys
+import types
+
+import ujson
+
+# the modules import each other as API.apihandlers, as when the repo is checked out as an API directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if "API" not in sys.modules:
+    package = types.ModuleType("API")
+    package.__path__ = [ROOT]
+    sys.modules["API"] = package
+
+from API.apihandlers import SingleFlight  # noqa: E402
+
+
+LIST_DEVICES = [{"Structure": {"Devices": [
+    {"DeviceName": "Vp_nere", "DeviceID": 1, "BuildingID": 10,
+     "Device": {"CurrentEnergyConsumed": 5, "LastTimeStamp": "2026-01-01T10:00:00", "RoomTemperature": 21.5, "Power": True,
+                "OperationMode": 1, "SetTemperature": 21, "FanSpeed": 3, "VaneVerticalDirection": 0, "VaneHorizontalDirection": 12,
+                "HasPendingCommand": False}},
+    {"DeviceName": "Vp_uppe", "DeviceID": 2, "BuildingID": 10,
+     "Device": {"CurrentEnergyConsumed": 6, "LastTimeStamp": "2026-01-01T10:00:00", "RoomTemperature": 20.0, "Power": False,
+                "OperationMode": 3, "SetTemperature": 22, "FanSpeed": 2, "VaneVerticalDirection": 7, "VaneHorizontalDirection": 8}}],
+    "Areas": [], "Floors": []}}]
+
+
+def ataResponse(deviceId):
+    return {"DeviceID": deviceId, "EffectiveFlags": 0, "RoomTemperature": 20.0 + deviceId, "Power": True, "OperationMode": 1,
+            "SetTemperature": 21, "SetFanSpeed": 3, "VaneVertical": 0, "VaneHorizontal": 12, "HasPendingCommand": False,
+            "LastCommunication": "2026-01-01T10:00:00", "NextCommunication": "2026-01-01T10:01:00", "DeviceType": 0, "Offline": False}
+
+
+class FakeHandler:
+    # stands in for APIMelcloud, answers Listdevices, Device/Get and SetAta from the fixtures above
+    def __init__(self):
+        self.calls = []
+        self.failSetAta = 0
+        self.setAtaPayloads = []
+        self.files = {}
+        self.fileUpdates = []
+        self.failListDevices = 0
+        self.failDeviceGet = set()  # DeviceIDs whose Device/Get gets no reply
+        self.rateLimiter = types.SimpleNamespace(delay=0)
+        self.singleFlight = SingleFlight()
+        self.delay = 0
+        self.reported = {}  # DeviceID -> state accepted by SetAta, reported by later Device/Get calls
+        self.inFlight = 0
+        self.maxInFlight = 0
+
+    async def doSession(self, priority=None, maxWait=None, **kwargs):
+        # identical GETs share one call like SINGLE_FLIGHT_GETS in APISessionHandler
+        if kwargs.get("method") == "GET":
+            key = (str(kwargs["url"]), tuple(sorted((kwargs.get("params") or {}).items())), priority)
+            return await self.singleFlight.do(key, lambda: self._answer(**kwargs))
+        return await self._answer(**kwargs)
+
+    async def _answer(self, **kwargs):
+        url = str(kwargs["url"])
+        self.calls.append((kwargs.get("method"), url.rsplit("/", 1)[-1]))
+        self.inFlight += 1
+        self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.inFlight -= 1
+        if url.endswith("Listdevices"):
+            if self.failListDevices:
+                self.failListDevices -= 1
+                return None
+            return copy.deepcopy(LIST_DEVICES)
+        if url.endswith("Device/Get"):
+            if kwargs["params"]["id"] in self.failDeviceGet:
+                return None
+            return copy.deepcopy(self.reported.get(kwargs["params"]["id"])) or ataResponse(kwargs["params"]["id"])
+        if url.endswith("SetAta"):
+            self.setAtaPayloads.append(ujson.loads(kwargs["data"]))
+            if self.failSetAta:
+                self.failSetAta -= 1
+                return None
+            accepted = ujson.loads(kwargs["data"])
+            self.reported[accepted["DeviceID"]] = {**accepted, "EffectiveFlags": 0, "HasPendingCommand": False}
+            return accepted
+
+    async def _readFileAsync(self, fileName):
+        return copy.deepcopy(self.files.get(fileName, {}))
+
+    async def _writeFileAsync(self, fileName, contents):
+        self.files[fileName] = copy.deepcopy(contents)
+
+    async def _updateFileAsync(self, fileName, key, value):
+        self.fileUpdates.append((fileName, key))
+        self.files.setdefault(fileName, {})[key] = copy.deepcopy(value)
+
+    async def logout(self):
+        pass
@@ -0,0 +1,56 @@
+import asyncio
+
+from conftest import FakeHandler
+from API import melcloudAPI_async
+from API.melcloudAPI_async import Melcloud
+
+
+def test_accounts_get_separate_files():
+    first = Melcloud(username="a@example.com")
+    second = Melcloud(username="b@example.com")
+    for attribute in ("tokenFileName", "lastSessionFileName", "deviceInfoFileName"):
+        assert getattr(first, attribute) != getattr(second, attribute)
+    assert Melcloud(username="A@example.com").tokenFileName == first.tokenFileName
+
+
+def test_account_name_sets_file_suffix():
+    assert Melcloud(username="a@example.com", accountName="home").tokenFileName.endswith("tokenfile_home.txt")
+
+
+def test_create_keys_instances_like_the_files(monkeypatch):
+    async def fakeCreate(**kwargs):
+        return FakeHandler()
+
+    monkeypatch.setattr(melcloudAPI_async.APIMelcloud, "create", fakeCreate)
+    monkeypatch.setattr(Melcloud, "instances", {})
+    monkeypatch.setattr(Melcloud, "legacyAdopted", True)
+    monkeypatch.setattr(Melcloud, "sharedConnector", object())
+
+    async def run():
+        first = await Melcloud.create("A@example.com", "secret")
+        second = await Melcloud.create("a@example.com", "secret")
+        other = await Melcloud.create("b@example.com", "secret")
+        return first, second, other
+
+    first, second, other = asyncio.run(run())
+    assert first is second
+    assert other is not first
+
+
+def test_legacy_files_are_taken_over_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(Melcloud, "DATA_DIR", str(tmp_path))
+    (tmp_path / "lastsessionfile.txt").write_text('{"time": "2026-01-01 10:00:00", "status": 429}\n')
+
+    async def run():
+        mc = Melcloud(username="a@example.com")
+        mc._adoptLegacyJournal()
+        mc.apiHandler = FakeHandler()
+        mc.apiHandler.files[f"{tmp_path}/tokenfile.txt"] = {"token": "abc"}
+        mc.apiHandler.files[f"{tmp_path}/deviceinfofile.txt"] = {"devices": {"Vp_nere": {"DeviceID": 1, "BuildingID": 10}}}
+        await mc._adoptLegacyFiles()
+        return mc
+
+    mc = asyncio.run(run())
+    assert (tmp_path / "lastsessionfile.txt").read_text() == open(mc.lastSessionFileName).read()
+    assert mc.apiHandler.files[mc.tokenFileName] == {"token": "abc"}
+    assert mc.apiHandler.files[mc.deviceInfoFileName]["devices"]["Vp_nere"]["DeviceID"] == 1
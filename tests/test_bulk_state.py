@@ -0,0 +1,16 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def test_bulk_last_communication_keeps_local_time():
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        await mc.getDevices(bulkState=True)
+        return mc
+
+    mc = asyncio.run(run())
+    # LastTimeStamp 2026-01-01T10:00:00 is already Europe/Stockholm time and must not be shifted again
+    assert mc.snapshot("Vp_nere")["LastCommunication"] == "2026-01-01 10:00:00"
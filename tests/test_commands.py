@@ -0,0 +1,83 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def _melcloud():
+    mc = Melcloud()
+    mc.apiHandler = FakeHandler()
+    return mc
+
+
+def test_coalesced_commands_send_one_set_ata():
+    async def run():
+        mc = _melcloud()
+        await mc.getOneDeviceInfo("Vp_nere")
+        results = await asyncio.gather(mc.setOneDeviceInfo("Vp_nere", {"T": 24}, coalesce=0.05),
+                                       mc.setOneDeviceInfo("Vp_nere", {"P": 0}, coalesce=0.05),
+                                       mc.setOneDeviceInfo("Vp_nere", {"F": 2}, coalesce=0.05))
+        return mc, results
+
+    mc, results = asyncio.run(run())
+    assert results == ["OK", "OK", "OK"]
+    payloads = mc.apiHandler.setAtaPayloads
+    assert len(payloads) == 1
+    flags = Melcloud.stateFields["T"][3] | Melcloud.stateFields["P"][3] | Melcloud.stateFields["F"][3]
+    assert payloads[0]["EffectiveFlags"] == flags
+    assert payloads[0]["SetTemperature"] == 24 and payloads[0]["Power"] is False and payloads[0]["SetFanSpeed"] == 2
+    assert mc.snapshot("Vp_nere")["CurrentState"]["T"] == 24
+
+
+def test_later_coalesced_value_wins():
+    async def run():
+        mc = _melcloud()
+        await mc.getOneDeviceInfo("Vp_nere")
+        await asyncio.gather(mc.setOneDeviceInfo("Vp_nere", {"T": 24}, coalesce=0.05),
+                             mc.setOneDeviceInfo("Vp_nere", {"T": 25}, coalesce=0.05))
+        return mc
+
+    mc = asyncio.run(run())
+    assert [payload["SetTemperature"] for payload in mc.apiHandler.setAtaPayloads] == [25]
+
+
+def test_confirmation_resolves_when_the_unit_reports_the_values():
+    async def run():
+        mc = _melcloud()
+        mc.CONFIRM_POLL_MIN = 0.01
+        mc.CONFIRM_POLL_MAX = 0.02
+        await mc.getOneDeviceInfo("Vp_nere")
+        confirmation = await mc.setOneDeviceInfo("Vp_nere", {"T": 24}, confirm=True, confirmTimeout=2)
+        return await asyncio.wait_for(confirmation, 2), mc
+
+    confirmed, mc = asyncio.run(run())
+    assert confirmed is True
+    assert mc.pendingConfirmations == {}
+
+
+def test_confirmation_times_out_and_shares_one_loop():
+    async def run():
+        mc = _melcloud()
+        mc.CONFIRM_POLL_MIN = 0.01
+        mc.CONFIRM_POLL_MAX = 0.02
+        await mc.refreshAllDevices()
+        mc.apiHandler.failDeviceGet = {1, 2}  # the units never report back
+        first = await mc.setOneDeviceInfo("Vp_nere", {"T": 24}, confirm=True, confirmTimeout=0.1)
+        task = mc.confirmTask
+        second = await mc.setOneDeviceInfo("Vp_uppe", {"T": 24}, confirm=True, confirmTimeout=0.1)
+        assert mc.confirmTask is task
+        return await asyncio.wait_for(asyncio.gather(first, second), 2)
+
+    assert asyncio.run(run()) == [False, False]
+
+
+def test_failed_command_returns_false_instead_of_a_confirmation():
+    async def run():
+        mc = _melcloud()
+        await mc.getOneDeviceInfo("Vp_nere")
+        mc.apiHandler.failSetAta = 1
+        return await mc.setOneDeviceInfo("Vp_nere", {"T": 24}, confirm=True), mc
+
+    result, mc = asyncio.run(run())
+    assert result is False
+    assert mc.pendingConfirmations == {}
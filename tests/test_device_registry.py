@@ -0,0 +1,38 @@
+import asyncio
+
+import conftest
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def test_registry_writes_only_changed_devices():
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        await mc.getDevices(bulkState=True)
+        first = list(mc.apiHandler.fileUpdates)
+        conftest.LIST_DEVICES[0]["Structure"]["Devices"][1]["Device"]["CurrentEnergyConsumed"] = 7
+        try:
+            await mc.getDevices(bulkState=True)
+        finally:
+            conftest.LIST_DEVICES[0]["Structure"]["Devices"][1]["Device"]["CurrentEnergyConsumed"] = 6
+        return mc, first
+
+    mc, first = asyncio.run(run())
+    assert [key for _, key in first] == ["Vp_nere", "Vp_uppe"]
+    assert [key for _, key in mc.apiHandler.fileUpdates[len(first):]] == ["Vp_uppe"]
+    assert mc.apiHandler.files[mc.deviceInfoFileName]["Vp_uppe"]["CurrentEnergyConsumed"] == 7
+
+
+def test_registry_reads_the_old_single_key_layout():
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        mc.apiHandler.files[mc.deviceInfoFileName] = {"devices": {"Vp_nere": {"DeviceID": 1, "BuildingID": 10}}}
+        await mc.getDevices()
+        return mc
+
+    mc = asyncio.run(run())
+    assert mc.devices["Vp_nere"].DeviceID == 1
+    assert mc.apiHandler.files[mc.deviceInfoFileName] == {"Vp_nere": {"DeviceID": 1, "BuildingID": 10}}
+    assert not [call for call in mc.apiHandler.calls if call[1] == "Listdevices"]
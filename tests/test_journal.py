@@ -0,0 +1,25 @@
+import asyncio
+
+import ujson
+
+from API.apihandlers import APISessionHandler
+
+
+def test_logout_persists_the_journal(tmp_path):
+    sessionFile = tmp_path / "lastsessionfile.txt"
+
+    async def run():
+        handler = await APISessionHandler.create(name="test", tokenFileName=str(tmp_path / "token.txt"), lastSessionFileName=str(sessionFile),
+                                                 headers={}, RETRIES=1, RETRY_DELAY=0, THROTTLE_DELAY=300, THROTTLE_ERROR_DELAY=3*60*60,
+                                                 loginUrls=["/l"], probeUrl=None, TOKEN_REFRESH_MARGIN=None)
+        handler._recordSession("/x", 429, "slow down", retryAfter=120)
+        await handler.logout()
+        return handler
+
+    handler = asyncio.run(run())
+    assert handler.journal.buffer == []
+    assert handler.persistTask is None
+    entries = [ujson.loads(line) for line in sessionFile.read_text().splitlines()]
+    assert entries[-1]["status"] == 429
+    assert entries[-1]["delay"] == 600
+    assert entries[-1]["blockedUntil"]
@@ -0,0 +1,70 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def _run(failSetAta):
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        mc.apiHandler.failSetAta = failSetAta
+        events = []
+
+        async def collect():
+            async for event in mc.subscribe():
+                events.append(event)
+
+        collector = asyncio.create_task(collect())
+        await asyncio.sleep(0)
+        task = await mc.setOneDeviceInfo("Vp_nere", {"T": 24}, optimistic=True)
+        immediate = mc.snapshot("Vp_nere")
+        result = await task
+        await asyncio.sleep(0)
+        collector.cancel()
+        return mc, immediate, result, events
+
+    return asyncio.run(run())
+
+
+def test_optimistic_values_published_before_first_fetch():
+    mc, immediate, result, events = _run(failSetAta=0)
+    assert immediate["CurrentState"]["T"] == 24
+    assert immediate["hasPendingCommand"]
+    assert result == "OK"
+    assert mc.snapshot("Vp_nere")["CurrentState"]["T"] == 24
+    assert mc.optimistic == {}
+
+
+def test_rollback_event_for_unit_without_baseline():
+    mc, immediate, result, events = _run(failSetAta=1)
+    assert immediate["CurrentState"]["T"] == 24
+    assert result is False
+    assert mc.snapshot("Vp_nere")["CurrentState"]["T"] == 21
+    rollbacks = [event for event in events if event.get("rollback")]
+    assert rollbacks and rollbacks[-1]["desiredState"] == {"T": 24}
+
+
+def test_rollback_event_when_unit_never_fetched():
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        events = []
+
+        async def collect():
+            async for event in mc.subscribe():
+                events.append(event)
+
+        collector = asyncio.create_task(collect())
+        await asyncio.sleep(0)
+        task = await mc.setOneDeviceInfo("Unknown", {"P": 1}, optimistic=True)
+        assert mc.snapshot("Unknown")["CurrentState"] == {"P": 1}
+        result = await task
+        await asyncio.sleep(0)
+        collector.cancel()
+        return mc, result, events
+
+    mc, result, events = asyncio.run(run())
+    assert result is False
+    assert mc.snapshot("Unknown") is None
+    assert events[-1]["rollback"] and events[-1]["deviceName"] == "Unknown"
@@ -0,0 +1,19 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def test_poller_fetches_every_cycle():
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        mc.startPoller(interval=0.05, jitter=0.1)
+        await asyncio.sleep(0.5)
+        mc.stopPoller()
+        return mc.apiHandler.calls
+
+    calls = asyncio.run(run())
+    fetches = [call for call in calls if call[1] == "Get"]
+    # roughly 10 cycles of 2 units, no cycle may be skipped as a cache hit
+    assert len(fetches) >= 2 * 8
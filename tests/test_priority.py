@@ -0,0 +1,111 @@
+import asyncio
+
+import arrow
+from aiohttp import web
+
+from API.apihandlers import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE_WRITE, APISessionHandler, PrioritySemaphore
+
+
+class Handler(APISessionHandler):
+    async def localDoLogin(self, internalCall, skipThrottle=True):
+        self.tokenExpires = arrow.now(self.TIME_ZONE).shift(hours=1)
+        return True
+
+
+def test_priority_semaphore_order():
+    async def run():
+        semaphore = PrioritySemaphore(1)
+        order = []
+
+        async def worker(name, priority):
+            async with semaphore.slot(priority):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        first = asyncio.create_task(worker("first", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        others = [asyncio.create_task(worker(f"background{i}", PRIORITY_BACKGROUND)) for i in range(3)]
+        others.append(asyncio.create_task(worker("write", PRIORITY_INTERACTIVE_WRITE)))
+        await asyncio.gather(first, *others)
+        return order
+
+    assert asyncio.run(run()) == ["first", "write", "background0", "background1", "background2"]
+
+
+def test_interactive_write_overtakes_queued_background_reads(tmp_path):
+    # 2 lanes, 6 background GETs queued before one interactive POST, the POST must not wait for the queued GETs
+    async def run():
+        arrivals = []
+
+        async def data(request):
+            arrivals.append(request.method + request.query.get("i", ""))
+            await asyncio.sleep(0.05)
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_get("/d", data)
+        app.router.add_post("/d", data)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        handler = await Handler.create(name="test", tokenFileName=str(tmp_path / "token.txt"), lastSessionFileName=None, headers={},
+                                       RETRIES=1, RETRY_DELAY=0, THROTTLE_DELAY=0.02, THROTTLE_ERROR_DELAY=0, MIN_THROTTLE_DELAY=0.02,
+                                       loginUrls=["/l"], BASE_URL=f"http://127.0.0.1:{port}", probeUrl=None,
+                                       TOKEN_REFRESH_MARGIN=None, MAX_CONCURRENT_REQUESTS=2)
+        try:
+            reads = [asyncio.create_task(handler.doSession(method="GET", url="/d", params={"i": str(i)}, priority=PRIORITY_BACKGROUND))
+                     for i in range(6)]
+            await asyncio.sleep(0)
+            write = asyncio.create_task(handler.doSession(method="POST", url="/d", priority=PRIORITY_INTERACTIVE_WRITE))
+            await asyncio.gather(write, *reads)
+        finally:
+            await handler.closeSession()
+            await runner.cleanup()
+        return arrivals
+
+    arrivals = asyncio.run(run())
+    assert len(arrivals) == 7
+    assert arrivals.index("POST") <= 2
+
+
+def test_retry_backoff_does_not_hold_a_lane(tmp_path):
+    # a 5xx backoff of RETRY_DELAY seconds must not keep the only lane from other requests
+    async def run():
+        async def failing(request):
+            return web.Response(status=503, text="busy")
+
+        async def ok(request):
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_get("/bad", failing)
+        app.router.add_get("/ok", ok)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        handler = await Handler.create(name="test", tokenFileName=str(tmp_path / "token.txt"), lastSessionFileName=None, headers={},
+                                       RETRIES=1, RETRY_DELAY=0.5, THROTTLE_DELAY=0, THROTTLE_ERROR_DELAY=0,
+                                       loginUrls=["/l"], BASE_URL=f"http://127.0.0.1:{port}", probeUrl=None,
+                                       TOKEN_REFRESH_MARGIN=None, MAX_CONCURRENT_REQUESTS=1)
+        try:
+            bad = asyncio.create_task(handler.doSession(method="GET", url="/bad"))
+            await asyncio.sleep(0.1)
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            result = await handler.doSession(method="GET", url="/ok")
+            elapsed = loop.time() - started
+            await bad
+        finally:
+            await handler.closeSession()
+            await runner.cleanup()
+        return result, elapsed
+
+    result, elapsed = asyncio.run(run())
+    assert result == {"ok": True}
+    assert elapsed < 0.3
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import arrow
+
+from API.apihandlers import RateLimiter, RequestDropped
+
+TIME_ZONE = "Europe/Stockholm"
+DATE_FORMAT = "YYYY-MM-DD HH:mm:ss"
+
+
+def test_load_429_with_learned_delay_does_not_restore_blackout():
+    now = arrow.now(TIME_ZONE)
+    limiter = RateLimiter(throttleDelay=300, throttleErrorDelay=3*60*60, minDelay=60)
+    limiter.load([{"time": now.format(DATE_FORMAT), "status": 429, "url": "/x", "delay": 600, "blockedUntil": None}], TIME_ZONE)
+    assert limiter.delay == 600
+    assert limiter.blockedUntil == 0
+    assert limiter._delay(time.time()) <= 600
+
+
+def test_load_legacy_429_keeps_error_delay_blackout():
+    now = arrow.now(TIME_ZONE)
+    limiter = RateLimiter(throttleDelay=300, throttleErrorDelay=3*60*60)
+    limiter.load([{"lastSessionTime": now.format(DATE_FORMAT), "lastStatus": 429}], TIME_ZONE)
+    assert limiter.blockedUntil > time.time() + 3*60*60 - 60
+
+
+def test_aimd_delay():
+    limiter = RateLimiter(throttleDelay=300, throttleErrorDelay=3*60*60, minDelay=60, decreaseStep=30)
+    limiter.record(429)
+    assert limiter.delay == 600
+    limiter.record(503)
+    assert limiter.delay == 1200
+    limiter.record(200)
+    assert limiter.delay == 1170
+    for _ in range(100):
+        limiter.record(200)
+    assert limiter.delay == 60
+    for _ in range(20):
+        limiter.record(429)
+    assert limiter.delay == 3*60*60
+
+
+def test_retry_after_blocks_calls():
+    limiter = RateLimiter(throttleDelay=0, throttleErrorDelay=0)
+    assert RateLimiter.parseRetryAfter("120") == 120
+    assert RateLimiter.parseRetryAfter("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert RateLimiter.parseRetryAfter("soon") is None
+    limiter.record(429, retryAfter=120)
+    assert 119 < limiter._delay(time.time()) <= 120
+
+
+def test_sliding_window_honours_backed_off_delay():
+    limiter = RateLimiter(300, 10800, maxCalls=10, timeframe=3600)
+    limiter.record(429)
+    assert limiter.delay == 600
+    assert limiter._delay(time.time()) > 599
+    limiter.record(200)
+    assert limiter._delay(time.time()) == 0
+
+
+def test_late_waiter_with_short_max_wait_is_dropped_on_time():
+    async def run():
+        limiter = RateLimiter(throttleDelay=5, throttleErrorDelay=5, jitter=0)
+        await limiter.acquire()
+        first = asyncio.create_task(limiter.acquire())  # puts the dispatcher to sleep for the whole delay
+        await asyncio.sleep(0.05)
+        started = time.time()
+        try:
+            await limiter.acquire(maxWait=0.1)
+        except RequestDropped:
+            pass
+        elapsed = time.time() - started
+        first.cancel()
+        return elapsed
+
+    assert asyncio.run(run()) < 1
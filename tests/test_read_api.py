@@ -0,0 +1,28 @@
+import asyncio
+import json
+
+import ujson
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def test_async_reads_return_serializable_dicts():
+    async def run():
+        mc = Melcloud()
+        mc.apiHandler = FakeHandler()
+        one = await mc.getOneDeviceInfo("Vp_nere")
+        everything = await mc.getAllDevice()
+        refreshed = await mc.refreshAllDevices()
+        devices = await mc.getDevicesInfo()
+        return mc, one, everything, refreshed, devices
+
+    mc, one, everything, refreshed, devices = asyncio.run(run())
+    for value in (one, everything, refreshed, devices):
+        json.dumps(value)
+        ujson.dumps(value)
+    assert type(one) is dict and type(one["CurrentState"]) is dict
+
+    # editing a returned copy does not change the published state
+    one["CurrentState"]["T"] = 30
+    assert mc.snapshot("Vp_nere")["CurrentState"]["T"] == 21
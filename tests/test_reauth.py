@@ -0,0 +1,46 @@
+import asyncio
+
+import arrow
+from aiohttp import web
+
+from API.apihandlers import APISessionHandler
+
+
+class Handler(APISessionHandler):
+    async def localDoLogin(self, internalCall, skipThrottle=True):
+        self.logins = getattr(self, "logins", 0) + 1
+        self.tokenExpires = arrow.now(self.TIME_ZONE).shift(hours=1)
+        return True
+
+
+def test_retry_after_reauthentication_counts_against_the_window(tmp_path):
+    async def run():
+        replies = [401]
+
+        async def data(request):
+            if replies:
+                return web.Response(status=replies.pop(), text="expired")
+            return web.json_response({"ok": True})
+
+        app = web.Application()
+        app.router.add_get("/d", data)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        handler = await Handler.create(name="test", tokenFileName=str(tmp_path / "token.txt"), lastSessionFileName=None, headers={},
+                                       RETRIES=3, RETRY_DELAY=0, THROTTLE_DELAY=0, THROTTLE_ERROR_DELAY=0, MAX_CALLS=10, TIMEFRAME_MAX_CALLS=3600,
+                                       loginUrls=["/l"], BASE_URL=f"http://127.0.0.1:{port}", probeUrl=None, TOKEN_REFRESH_MARGIN=None)
+        try:
+            result = await handler.doSession(method="GET", url="/d")
+        finally:
+            await handler.closeSession()
+            await runner.cleanup()
+        return handler, result
+
+    handler, result = asyncio.run(run())
+    assert result == {"ok": True}
+    assert handler.logins == 2
+    assert len(handler.rateLimiter.callTimes) == 2
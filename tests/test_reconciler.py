@@ -0,0 +1,72 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def _melcloud():
+    mc = Melcloud()
+    mc.apiHandler = FakeHandler()
+    return mc
+
+
+def _setAtaCalls(mc):
+    return [call for call in mc.apiHandler.calls if call[1] == "SetAta"]
+
+
+def test_matching_target_sends_nothing():
+    async def run():
+        mc = _melcloud()
+        mc.setTarget("Vp_nere", {"P": 1, "M": 0, "T": 21})
+        await asyncio.sleep(0.05)
+        mc.stopReconciler()
+        return mc
+
+    mc = asyncio.run(run())
+    assert _setAtaCalls(mc) == []
+
+
+def test_only_drift_is_sent_and_failures_retry():
+    async def run():
+        mc = _melcloud()
+        mc.RECONCILE_RETRY_MIN = 0.01
+        mc.apiHandler.failSetAta = 1
+        mc.setTarget("Vp_nere", {"P": 1, "T": 23})
+        await asyncio.sleep(0.2)
+        mc.stopReconciler()
+        return mc
+
+    mc = asyncio.run(run())
+    assert len(_setAtaCalls(mc)) == 2
+    assert mc.snapshot("Vp_nere")["CurrentState"]["T"] == 23
+    assert mc.reconcileRetry == {}
+
+
+def test_retry_cleared_when_drift_goes_away():
+    # a failed send followed by the unit reaching the target must not leave a past retry time that spins the loop
+    async def run():
+        mc = _melcloud()
+        mc.RECONCILE_RETRY_MIN = 0.1
+        mc.apiHandler.failSetAta = 1
+        mc.setTarget("Vp_nere", {"T": 23})
+        await asyncio.sleep(0.05)
+        assert "Vp_nere" in mc.reconcileRetry
+
+        mc.targets["Vp_nere"] = {"T": 21}
+        iterations = 0
+        reconcileOne = mc._reconcileOne
+
+        async def countingReconcileOne(deviceName):
+            nonlocal iterations
+            iterations += 1
+            await reconcileOne(deviceName)
+
+        mc._reconcileOne = countingReconcileOne
+        await asyncio.sleep(0.3)
+        mc.stopReconciler()
+        return mc, iterations
+
+    mc, iterations = asyncio.run(run())
+    assert mc.reconcileRetry == {}
+    assert iterations < 5
+    assert len(_setAtaCalls(mc)) == 1
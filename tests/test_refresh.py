@@ -0,0 +1,84 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def _melcloud():
+    mc = Melcloud()
+    mc.apiHandler = FakeHandler()
+    return mc
+
+
+def _deviceGets(mc):
+    return [call for call in mc.apiHandler.calls if call[1] == "Get"]
+
+
+def test_bulk_refresh_falls_back_to_device_get_when_listdevices_fails():
+    async def run():
+        mc = _melcloud()
+        await mc.refreshAllDevices(bulkState=True)
+        gets = len(_deviceGets(mc))
+        mc.apiHandler.failListDevices = 1
+        result = await mc.refreshAllDevices(bulkState=True)
+        return mc, gets, result
+
+    mc, gets, result = asyncio.run(run())
+    assert result["errors"] == {}
+    assert len(_deviceGets(mc)) == gets + 2
+
+
+def test_bulk_refresh_reports_errors_when_everything_fails():
+    async def run():
+        mc = _melcloud()
+        await mc.refreshAllDevices(bulkState=True)
+        mc.apiHandler.failListDevices = 1
+        mc.apiHandler.failDeviceGet = {1, 2}
+        return await mc.refreshAllDevices(bulkState=True)
+
+    result = asyncio.run(run())
+    assert set(result["errors"]) == {"Vp_nere", "Vp_uppe"}
+
+
+def test_concurrent_reads_share_one_device_get():
+    async def run():
+        mc = _melcloud()
+        mc.apiHandler.delay = 0.02
+        results = await asyncio.gather(*[mc.getOneDeviceInfo("Vp_nere") for _ in range(5)])
+        return mc, results
+
+    mc, results = asyncio.run(run())
+    assert len(_deviceGets(mc)) == 1
+    assert len([call for call in mc.apiHandler.calls if call[1] == "Listdevices"]) == 1
+    assert all(result == results[0] for result in results)
+
+
+def test_refresh_reports_per_device_errors():
+    async def run():
+        mc = _melcloud()
+        mc.apiHandler.failDeviceGet = {2}
+        return await mc.refreshAllDevices()
+
+    result = asyncio.run(run())
+    assert set(result["devices"]) == {"Vp_nere"}
+    assert set(result["errors"]) == {"Vp_uppe"}
+    assert "no reply from Device/Get" in result["errors"]["Vp_uppe"]
+
+
+def test_refresh_fan_out_is_bounded():
+    async def run():
+        mc = _melcloud()
+        mc.apiHandler.delay = 0.02
+        await mc.getDevices()
+        mc.apiHandler.maxInFlight = 0
+        one = await mc.refreshAllDevices(maxConcurrency=1)
+        serialMax = mc.apiHandler.maxInFlight
+        mc.apiHandler.maxInFlight = 0
+        two = await mc.refreshAllDevices(maxConcurrency=2)
+        return mc, one, two, serialMax
+
+    mc, one, two, serialMax = asyncio.run(run())
+    assert one["errors"] == {} and two["errors"] == {}
+    assert serialMax == 1
+    assert mc.apiHandler.maxInFlight == 2
+    assert len(_deviceGets(mc)) == 4
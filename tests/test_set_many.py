@@ -0,0 +1,57 @@
+import asyncio
+
+from conftest import FakeHandler
+from API.melcloudAPI_async import Melcloud
+
+
+def _melcloud():
+    mc = Melcloud()
+    mc.apiHandler = FakeHandler()
+    return mc
+
+
+def test_cached_units_keep_their_full_state():
+    async def run():
+        mc = _melcloud()
+        await mc.getOneDeviceInfo("Vp_nere")
+        result = await mc.setManyDevices({"Vp_nere": {"T": 24}, "Vp_uppe": {"P": 1}})
+        return mc, result
+
+    mc, result = asyncio.run(run())
+    assert result == {"devices": {"Vp_nere": "OK", "Vp_uppe": "OK"}, "errors": {}}
+    listCalls = [call for call in mc.apiHandler.calls if call[1] == "Listdevices"]
+    assert len(listCalls) == 1
+    # both SetAta calls were built from Device/Get states, not from thinner Listdevices records
+    payloads = {payload["DeviceID"]: payload for payload in mc.apiHandler.setAtaPayloads}
+    assert payloads[1]["NextCommunication"] == "2026-01-01T10:01:00"
+    assert payloads[2]["NextCommunication"] == "2026-01-01T10:01:00"
+    assert mc.ataNextFetch["Vp_nere"] > 0
+
+
+def test_partial_failure_is_reported_per_device():
+    async def run():
+        mc = _melcloud()
+        await mc.refreshAllDevices()
+        mc.apiHandler.failSetAta = 1
+        # one write at a time so the first SetAta, the one that fails, is Vp_nere's
+        return mc, await mc.setManyDevices({"Vp_nere": {"T": 24}, "Vp_uppe": {"T": 23}, "Unknown": {"P": 1}}, maxConcurrency=1)
+
+    mc, result = asyncio.run(run())
+    assert result["devices"] == {"Vp_uppe": "OK"}
+    assert set(result["errors"]) == {"Vp_nere", "Unknown"}
+    assert result["errors"]["Vp_nere"] == "SetAta failed"
+    assert [payload["DeviceID"] for payload in mc.apiHandler.setAtaPayloads] == [1, 2]
+    assert mc.snapshot("Vp_uppe")["CurrentState"]["T"] == 23
+
+
+def test_writes_run_concurrently():
+    async def run():
+        mc = _melcloud()
+        await mc.refreshAllDevices()
+        mc.apiHandler.delay = 0.02
+        mc.apiHandler.maxInFlight = 0
+        return mc, await mc.setManyDevices({"Vp_nere": {"T": 24}, "Vp_uppe": {"T": 23}})
+
+    mc, result = asyncio.run(run())
+    assert result["errors"] == {}
+    assert mc.apiHandler.maxInFlight == 2
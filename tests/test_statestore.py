@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+from API.apihandlers import APISessionHandler, StateStore
+
+
+def test_state_store_roundtrip(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.write("tokenfile", {"token": "abc", "expires": "2026-01-01 10:00:00"})
+    store.write("tokenfile", {"token": "def"})
+    assert store.read("tokenfile") == {"token": "def"}
+    assert store.read("missing") == {}
+
+
+def test_handler_imports_json_file_into_store(tmp_path):
+    tokenFile = tmp_path / "tokenfile.txt"
+    tokenFile.write_text(json.dumps({"token": "abc"}))
+
+    async def run():
+        handler = await APISessionHandler.create(name="test", tokenFileName=str(tokenFile), lastSessionFileName=None, headers={},
+                                                 RETRIES=1, RETRY_DELAY=0, THROTTLE_DELAY=0, THROTTLE_ERROR_DELAY=0, loginUrls=["/l"],
+                                                 stateStoreFileName=str(tmp_path / "state.db"), probeUrl=None, TOKEN_REFRESH_MARGIN=None)
+        try:
+            imported = await handler._readFileAsync(str(tokenFile))
+            tokenFile.unlink()
+            await handler._writeFileAsync(str(tokenFile), {"token": "def"})
+            return imported, await handler._readFileAsync(str(tokenFile))
+        finally:
+            await handler.closeSession()
+
+    imported, stored = asyncio.run(run())
+    assert imported == {"token": "abc"}
+    assert stored == {"token": "def"}
+
+
+def test_state_store_update_replaces_one_key(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.write("deviceinfo", {"Vp_nere": {"DeviceID": 1}, "Vp_uppe": {"DeviceID": 2}})
+    store.update("deviceinfo", "Vp_uppe", {"DeviceID": 3})
+    store.update("deviceinfo", "Vp_extra", {"DeviceID": 4})
+    assert store.read("deviceinfo") == {"Vp_nere": {"DeviceID": 1}, "Vp_uppe": {"DeviceID": 3}, "Vp_extra": {"DeviceID": 4}}
+
+
+def test_handler_update_file(tmp_path):
+    async def run():
+        handler = await APISessionHandler.create(name="test", tokenFileName=str(tmp_path / "token.txt"), lastSessionFileName=None, headers={},
+                                                 RETRIES=1, RETRY_DELAY=0, THROTTLE_DELAY=0, THROTTLE_ERROR_DELAY=0, loginUrls=["/l"],
+                                                 stateStoreFileName=str(tmp_path / "state.db"), probeUrl=None, TOKEN_REFRESH_MARGIN=None)
+        try:
+            await handler._writeFileAsync("deviceinfo", {"a": 1, "b": 2})
+            await handler._updateFileAsync("deviceinfo", "b", 3)
+            return await handler._readFileAsync("deviceinfo")
+        finally:
+            await handler.closeSession()
+
+    assert asyncio.run(run()) == {"a": 1, "b": 3}